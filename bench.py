@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+import os, sys, io, time
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random
+import signal
+import socket
+import subprocess
+import tracemalloc
+
+import main, wsgif
+
+def emit(record):
+    print(json.dumps(record, sort_keys=True), flush=True)
+
+def random_upload(rng):
+    return ['%05d' % rng.randrange(100000) for i in range(rng.randint(1, 11))]
+
+def bench_queue(args):
+    rng = random.Random(args.seed)
+    for depth in args.depths:
+        queue = main.NumberQueue()
+        index = 0
+        begin = time.perf_counter()
+        while len(queue.queued) < depth:
+            queue.add(random_upload(rng), index + 10)
+        fill = time.perf_counter() - begin
+        # Steady state: one slot rotates and one upload arrives per step.
+        uploads = [random_upload(rng) for i in range(args.ops)]
+        begin = time.perf_counter()
+        for values in uploads:
+            index += 5
+            queue.pop(index)
+            queue.add(values, index + 10)
+        elapsed = time.perf_counter() - begin
+        emit({'bench': 'queue', 'depth': depth, 'ops': args.ops,
+              'fill_seconds': fill,
+              'op_microseconds': elapsed / args.ops * 1e6})
+
+def linear_match(routes, method, path):
+    # The dispatch loop wsgif.Router used before routes were compiled.
+    for routepath, extend, rmethod, callback in routes:
+        if rmethod is not None and method != rmethod:
+            continue
+        elif not extend:
+            if path != routepath: continue
+        elif not path.startswith(routepath):
+            continue
+        elif not routepath.endswith('/'):
+            lrp = len(routepath)
+            if len(path) > lrp and path[lrp] != '/': continue
+        return (routepath, callback)
+    return None
+
+def compiled_match(table, method, path):
+    match = wsgif.match_route(table, method, path)
+    return None if match is None else match[1:3]
+
+def bench_router(args):
+    rng = random.Random(args.seed)
+    for count in args.counts:
+        # The application's own routes come last, so that requests for them
+        # have to get past every filler route in a linear scan.
+        routes = []
+        for i in range(count):
+            path = '/filler%d' % i
+            if rng.random() < 0.5: path += '/*'
+            routes.append((path, rng.choice(('GET', 'POST')), None))
+        builder = wsgif.RouteBuilder()
+        for path, method, handler in routes:
+            builder.add(path, handler, method)
+        builder.routes.extend(main.route.routes)
+        table = wsgif.compile_routes(builder.routes)
+        requests = [(m, p) for m, p in (('GET', '/'), ('GET', '/data'),
+                                        ('GET', '/data/stream'),
+                                        ('POST', '/data/bulk'),
+                                        ('GET', '/sprite/0123.mp3'),
+                                        ('GET', '/d0c.mp3'),
+                                        ('PUT', '/missing'))]
+        for method, path in requests:
+            assert (linear_match(builder.routes, method, path) ==
+                    compiled_match(table, method, path))
+        for name, func, arg in (('linear', linear_match, builder.routes),
+                                ('compiled', wsgif.match_route, table)):
+            begin = time.perf_counter()
+            for i in range(args.rounds):
+                for method, path in requests:
+                    func(arg, method, path)
+            elapsed = time.perf_counter() - begin
+            emit({'bench': 'router', 'dispatch': name, 'routes': len(routes),
+                  'lookups': args.rounds * len(requests),
+                  'lookup_microseconds':
+                      elapsed / (args.rounds * len(requests)) * 1e6})
+
+def make_environ(path, query='', method='GET', body=b''):
+    return {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path,
+            'QUERY_STRING': query, 'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr}
+
+def ignore_response(status, headers, exc_info=None):
+    pass
+
+def bench_alloc(args):
+    # Retained: memory held by live in-flight requests, measured by keeping
+    # them all alive. Peak: the high-water mark while serving one request.
+    index = int(time.time() / 5) * 5
+    query = 't=%s' % index
+    environs = [make_environ('/data', query) for i in range(args.requests)]
+    for i in range(100):
+        b''.join(main.application(make_environ('/data', query),
+                                  ignore_response))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    live = []
+    for environ in environs:
+        result = main.application(environ, ignore_response)
+        b''.join(result)
+        live.append(result)
+    after = tracemalloc.take_snapshot()
+    stats = after.compare_to(before, 'filename')
+    size = sum(s.size_diff for s in stats)
+    count = sum(s.count_diff for s in stats)
+    del live
+    peak = 0
+    for environ in environs[:1000]:
+        environ['wsgi.input'] = io.BytesIO()
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        b''.join(main.application(environ, ignore_response))
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    emit({'bench': 'alloc', 'path': '/data', 'requests': args.requests,
+          'retained_bytes': size / args.requests,
+          'retained_blocks': count / args.requests,
+          'peak_bytes': peak})
+
+STATIC_PATHS = ('/', '/font.woff', '/sprite.json', '/d0c.mp3')
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def summarize(mode, kind, results, elapsed):
+    latencies = sorted(r[2] for r in results)
+    errors = sum(1 for r in results if r[1] is None or r[1] >= 500)
+    record = {'bench': 'load', 'mode': mode, 'kind': kind,
+              'requests': len(results), 'errors': errors}
+    if latencies:
+        record.update(throughput=len(results) / elapsed,
+                      p50_ms=percentile(latencies, 0.5) * 1e3,
+                      p99_ms=percentile(latencies, 0.99) * 1e3,
+                      max_ms=latencies[-1] * 1e3)
+    return record
+
+def plan_herd(rng, args, index):
+    # Every client asks for the new slot; some also upload or fetch a
+    # static file, as a page (re)load would.
+    ret = []
+    for client in range(args.clients):
+        reqs = [('data', 'GET', '/data', 't=%d' % index, b'')]
+        if rng.random() < args.uploads:
+            body = 'd=' + '+'.join(random_upload(rng))
+            reqs.append(('upload', 'POST', '/data', '', body.encode('ascii')))
+        if rng.random() < args.statics:
+            reqs.append(('static', 'GET', rng.choice(STATIC_PATHS), '', b''))
+        ret.append(reqs)
+    return ret
+
+def wait_for_slot(args):
+    # Returns the index of the slot to request, right as it starts.
+    if not args.align:
+        return int(time.time() / 5) * 5
+    index = (int(time.time() / 5) + 1) * 5
+    time.sleep(max(index - time.time(), 0))
+    return index
+
+def run_herds(args, mode, fire):
+    rng = random.Random(args.seed)
+    results, elapsed, herds = [], 0, []
+    for i in range(args.slots):
+        index = wait_for_slot(args)
+        plan = plan_herd(rng, args, index)
+        begin = time.perf_counter()
+        herd = fire(plan)
+        duration = time.perf_counter() - begin
+        results.extend(herd)
+        elapsed += duration
+        herds.append(duration)
+    for kind in ('data', 'upload', 'static'):
+        emit(summarize(mode, kind, [r for r in results if r[0] == kind],
+                       elapsed))
+    record = summarize(mode, 'all', results, elapsed)
+    record.update(clients=args.clients, slots=args.slots,
+                  herd_seconds=max(herds))
+    return record
+
+def call_inprocess(request):
+    kind, method, path, query, body = request
+    status = []
+    def start_response(line, headers, exc_info=None):
+        status.append(int(line[:3]))
+    begin = time.perf_counter()
+    try:
+        result = main.application(make_environ(path, query, method, body),
+                                  start_response)
+        try:
+            for chunk in result: pass
+        finally:
+            result.close()
+    except Exception:
+        status.append(None)
+    return (kind, status[0], time.perf_counter() - begin)
+
+def bench_load_inprocess(args):
+    executor = concurrent.futures.ThreadPoolExecutor(args.threads)
+    def fire(plan):
+        def client(reqs):
+            return [call_inprocess(r) for r in reqs]
+        return [r for rs in executor.map(client, plan) for r in rs]
+    # Warm up caches and the thread pool outside of the measurement.
+    fire([[('static', 'GET', p, '', b'')] for p in STATIC_PATHS] * 4)
+    if args.trace_alloc:
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+    record = run_herds(args, 'inprocess', fire)
+    if args.trace_alloc:
+        requests = record['requests']
+        record.update(peak_bytes=tracemalloc.get_traced_memory()[1],
+                      retained_blocks_per_request=
+                          (sys.getallocatedblocks() - blocks) / requests)
+        tracemalloc.stop()
+    executor.shutdown()
+    emit(record)
+
+async def http_request(reader, writer, method, path, query, body):
+    target = path + ('?' + query if query else '')
+    head = ('%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n'
+            % (method, target, len(body)))
+    if body:
+        head += 'Content-Type: application/x-www-form-urlencoded\r\n'
+    writer.write(head.encode('ascii') + b'\r\n' + body)
+    await writer.drain()
+    version, status = (await reader.readline()).split()[:2]
+    length, keep_alive = 0, version == b'HTTP/1.1'
+    while 1:
+        line = await reader.readline()
+        if line in (b'\r\n', b''): break
+        name, _, value = line.partition(b':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            keep_alive = value == b'keep-alive'
+    await reader.readexactly(length)
+    return int(status), keep_alive
+
+async def run_clients(port, plan, connections, timeout):
+    async def request(i, method, path, query, body):
+        if connections[i] is None:
+            connections[i] = await asyncio.open_connection('127.0.0.1', port)
+        status, keep_alive = await http_request(*connections[i], method,
+                                                path, query, body)
+        if not keep_alive:
+            connections[i][1].close()
+            connections[i] = None
+        return status
+    async def client(i, reqs):
+        ret = []
+        for kind, method, path, query, body in reqs:
+            begin = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(
+                    request(i, method, path, query, body), timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError):
+                if connections[i] is not None: connections[i][1].close()
+                connections[i], status = None, None
+            ret.append((kind, status, time.perf_counter() - begin))
+        return ret
+    herds = await asyncio.gather(*(client(i, reqs)
+                                   for i, reqs in enumerate(plan)))
+    return [r for rs in herds for r in rs]
+
+def start_server(args):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, main.__file__, '--host',
+                             '127.0.0.1', '--port', str(port), '--server',
+                             args.server, '--threads', str(args.threads),
+                             '--workers', str(args.workers)],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    deadline = time.time() + 10
+    while 1:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc, port
+        except OSError:
+            if time.time() > deadline or proc.poll() is not None:
+                stop_server(proc)
+                raise RuntimeError('Server did not start')
+            time.sleep(0.1)
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+def server_max_rss(proc):
+    # Linux only; the high-water mark of the parent server process.
+    try:
+        with open('/proc/%d/status' % proc.pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1])
+    except OSError:
+        return None
+
+def bench_load_loopback(args):
+    proc, port = start_server(args)
+    loop = asyncio.new_event_loop()
+    try:
+        connections = [None] * args.clients
+        def fire(plan):
+            return loop.run_until_complete(run_clients(port, plan,
+                                                       connections,
+                                                       args.timeout))
+        fire([[('static', 'GET', p, '', b'')] for p in STATIC_PATHS])
+        record = run_herds(args, 'loopback', fire)
+        record.update(server=args.server, workers=args.workers,
+                      server_max_rss_kb=server_max_rss(proc))
+        for conn in connections:
+            if conn is not None: conn[1].close()
+        emit(record)
+    finally:
+        loop.close()
+        stop_server(proc)
+
+def bench_load(args):
+    if args.mode in ('inprocess', 'both'):
+        bench_load_inprocess(args)
+    if args.mode in ('loopback', 'both'):
+        bench_load_loopback(args)
+
+def main_():
+    p = argparse.ArgumentParser(description='Benchmark parts of the server')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Random seed (default %(default)s)')
+    sp = p.add_subparsers(dest='bench', required=True)
+    q = sp.add_parser('queue', help='Upload queue insertion and expiry')
+    q.add_argument('--depths', type=int, nargs='+',
+                   default=[1000, 10000, 100000],
+                   help='Queue sizes to measure at (default %(default)s)')
+    q.add_argument('--ops', type=int, default=10000,
+                   help='Operations per depth (default %(default)s)')
+    r = sp.add_parser('router', help='Route dispatch, linear against compiled')
+    r.add_argument('--counts', type=int, nargs='+', default=[0, 10, 100],
+                   help='Extra routes to register (default %(default)s)')
+    r.add_argument('--rounds', type=int, default=20000,
+                   help='Passes over the request mix (default %(default)s)')
+    m = sp.add_parser('alloc', help='Memory allocated per /data request')
+    m.add_argument('--requests', type=int, default=10000,
+                   help='Requests to keep alive (default %(default)s)')
+    l = sp.add_parser('load', help='Clients converging on slot boundaries')
+    l.add_argument('--mode', choices=('inprocess', 'loopback', 'both'),
+                   default='both', help='Where to send requests '
+                                        '(default %(default)s)')
+    l.add_argument('--clients', type=int, default=1000,
+                   help='Simulated clients (default %(default)s)')
+    l.add_argument('--slots', type=int, default=3,
+                   help='Slot boundaries to measure (default %(default)s)')
+    l.add_argument('--uploads', type=float, default=0.05,
+                   help='Share of clients uploading (default %(default)s)')
+    l.add_argument('--statics', type=float, default=0.1,
+                   help='Share of clients fetching a static file '
+                        '(default %(default)s)')
+    l.add_argument('--no-align', dest='align', action='store_false',
+                   help='Fire immediately instead of at slot boundaries')
+    l.add_argument('--threads', type=int, default=64,
+                   help='Worker threads, in process and in the server '
+                        '(default %(default)s)')
+    l.add_argument('--server', choices=('wsgiref', 'asyncio'),
+                   default='asyncio',
+                   help='Server for loopback mode (default %(default)s)')
+    l.add_argument('--workers', type=int, default=1,
+                   help='Server worker processes (default %(default)s)')
+    l.add_argument('--timeout', type=float, default=10,
+                   help='Seconds before a loopback request counts as failed '
+                        '(default %(default)s)')
+    l.add_argument('--trace-alloc', action='store_true',
+                   help='Trace allocations in process (slow)')
+    a = p.parse_args()
+    {'queue': bench_queue, 'router': bench_router, 'alloc': bench_alloc,
+     'load': bench_load}[a.bench](a)
+
+if __name__ == '__main__': main_()
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: ascii -*-
 
-import os, re, time, inspect
+import os, io, re, time, inspect
+import asyncio
+import bisect
 import collections
+import contextlib
+import fcntl
+import glob
+import hashlib
+import hmac
+import json
+import mmap
+import pickle
 import random
+import struct
+import tempfile
 import threading
+import traceback
 import urllib.parse
 import wsgif
 
@@ -15,124 +28,709 @@ DEFAULT_MARKER = '31337'
 
 RANDOM = random.SystemRandom()
 
+SOURCE_RANDOM, SOURCE_UPLOAD, SOURCE_MARKER, SOURCE_DERIVED = range(1, 5)
+
+# Upper bound on uploaded values waiting for a slot (about a month's worth).
+MAX_QUEUED_VALUES = 500000
+# Uploaded values are remembered this long after their slot was emitted,
+# so that past slots can be served without an archive.
+UPLOAD_MEMORY = 86400
+# Freshness of past slots that might have been replaced by an upload the
+# server no longer knows about.
+UNSETTLED_MAX_AGE = 60
+
+METRICS = wsgif.Metrics()
+LOOKUPS = METRICS.counter('numbers_lookups_total',
+                          'Slot lookups on /data by result code', ('code',))
+LOCK_WAIT = METRICS.histogram('numbers_lock_wait_seconds',
+                              'Time spent waiting for the number supply lock',
+                              buckets=(1e-6, 1e-5, 1e-4, 1e-3, 0.01, 0.1, 1))
+UPLOADS = METRICS.counter('numbers_uploads_total',
+                          'Upload requests by endpoint and outcome',
+                          ('endpoint', 'result'))
+UPLOADED_VALUES = METRICS.counter('numbers_uploaded_values_total',
+                                  'Values accepted into the upload queue')
+
+SlotResponse = collections.namedtuple('SlotResponse',
+                                      'index value expires etag body headers')
+Snapshot = collections.namedtuple(
+    'Snapshot', 'refresh_at index value next_value responses')
+
+def make_slot_response(index, value, expires):
+    body = urllib.parse.urlencode({'t': index, 'd': value}).encode('ascii')
+    etag = '"{}-{}"'.format(index, value)
+    # The first two headers are left out of 304 responses.
+    base_headers = (('Content-Type', 'application/x-www-form-urlencoded'),
+                    ('Content-Length', str(len(body))),
+                    ('ETag', etag),
+                    ('Expires', wsgif.format_http_date(expires)))
+    # Pre-render one header list per possible max-age value; the slot
+    # expires at most 13 seconds after it became valid.
+    headers = tuple(base_headers + (('Cache-Control',
+                                     'max-age={}'.format(age)),)
+                    for age in range(14))
+    return SlotResponse(index, value, expires, etag, body, headers)
+
+def _make_fit_table():
+    # For every occupancy mask of the eleven slots between two sync words,
+    # the position of the first free run of each length (or None).
+    table = []
+    for mask in range(1 << 11):
+        fits, run_start, run = [None] * 12, 0, 0
+        for k in range(11):
+            if mask >> k & 1:
+                run = 0
+                continue
+            if run == 0: run_start = k
+            run += 1
+            if fits[run] is None: fits[run] = run_start
+        table.append(tuple(fits))
+    return tuple(table)
+
+FIT_TABLE = _make_fit_table()
+LONGEST_RUN = tuple(max(n for n in range(12) if n == 0 or fits[n] is not None)
+                    for fits in FIT_TABLE)
+
 class NumberQueue:
     def __init__(self, marker=None):
         if marker is None: marker = DEFAULT_MARKER
         self.marker = marker
         self.queued = {}
-        self.queued_range = None
+        # Occupancy bitmasks of minutes with queued values, the sorted list
+        # of those minutes, and for every run length the sorted minutes that
+        # still have a free run that long.
+        self.windows = {}
+        self.order = []
+        self.fitting = [[] for n in range(12)]
 
-    def _available_indices(self, idx):
-        while 1:
-            if not idx % 60 or idx in self.queued:
-                idx += 5
-                continue
-            for offset in range(1, 12):
-                si = idx + 5 * offset
-                if si % 60 and si not in self.queued: continue
-                yield (idx, offset)
-                break
-            idx = si + 5
-
-    def _update_range(self, add_range):
-        if self.queued_range is None:
-            self.queued_range = add_range
+    def _set_mask(self, base, mask):
+        old = self.windows.get(base)
+        if old is None:
+            bisect.insort(self.order, base)
+            old_longest = 0
         else:
-            self.queued_range = [min(self.queued_range[0], add_range[0]),
-                                 max(self.queued_range[1], add_range[1])]
+            old_longest = LONGEST_RUN[old]
+        self.windows[base] = mask
+        new_longest = LONGEST_RUN[mask]
+        for n in range(new_longest + 1, old_longest + 1):
+            fitting = self.fitting[n]
+            del fitting[bisect.bisect_left(fitting, base)]
+        for n in range(old_longest + 1, new_longest + 1):
+            bisect.insort(self.fitting[n], base)
+
+    def _drop_window(self, base):
+        mask = self.windows.pop(base)
+        for n in range(1, LONGEST_RUN[mask] + 1):
+            fitting = self.fitting[n]
+            del fitting[bisect.bisect_left(fitting, base)]
+        del self.order[bisect.bisect_left(self.order, base)]
+        for k in range(11):
+            if mask >> k & 1: del self.queued[base + 5 * (k + 1)]
 
     def add(self, values, start_idx):
         assert len(values) <= 11
-        for idx, count in self._available_indices(start_idx):
-            if count < len(values): continue
-            for offset, v in enumerate(values):
-                self.queued[idx + 5 * offset] = v
-            self._update_range([idx, idx + 5 * len(values)])
-            break
+        if not values: return
+        count = len(values)
+        base = start_idx - start_idx % 60
+        # Slots of the first minute before start_idx are not available.
+        past = (1 << max((start_idx - base) // 5 - 1, 0)) - 1
+        pos = FIT_TABLE[self.windows.get(base, 0) | past][count]
+        if pos is None:
+            fitting = self.fitting[count]
+            i = bisect.bisect_right(fitting, base)
+            if i < len(fitting):
+                base = fitting[i]
+            elif self.order:
+                base = max(base, self.order[-1]) + 60
+            else:
+                base += 60
+            pos = FIT_TABLE[self.windows.get(base, 0)][count]
+        for offset, v in enumerate(values):
+            self.queued[base + 5 * (pos + 1 + offset)] = v
+        self._set_mask(base, self.windows.get(base, 0) |
+                             ((1 << count) - 1) << pos)
 
     def pop(self, idx):
         if idx % 60 == 0:
             return self.marker
 
-        if self.queued_range is None:
+        base = idx - idx % 60
+        while self.order and self.order[0] < base:
+            self._drop_window(self.order[0])
+        mask = self.windows.get(base)
+        if mask is None:
             return None
 
-        if idx >= self.queued_range[1]:
-            self.queued.clear()
-            self.queued_range = None
-        elif idx > self.queued_range[0]:
-            for i in range(self.queued_range[0], idx, 5):
-                self.queued.pop(i, None)
-            self.queued_range[0] = idx + 5
+        # Discard everything up to and including idx.
+        pos = (idx - base) // 5 - 1
+        value = self.queued.pop(idx, None)
+        consumed = mask & ((2 << pos) - 1)
+        for k in range(pos):
+            if consumed >> k & 1: del self.queued[base + 5 * (k + 1)]
+        self._set_mask(base, mask & ~consumed)
+        return value
+
+def _wake(future):
+    if not future.done(): future.set_result(None)
+
+class QueueFull(Exception):
+    pass
+
+class SlotBroadcaster:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.serial = 0
+        # (loop, future) pairs of listeners waiting on an event loop.
+        self.waiters = set()
+
+    def publish(self):
+        with self.cond:
+            self.serial += 1
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def wait(self, serial, timeout=None):
+        with self.cond:
+            if self.serial == serial:
+                self.cond.wait(timeout)
+            return self.serial
+
+    async def wait_async(self, serial, timeout=None):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if self.serial != serial: return self.serial
+            waiter = (loop, loop.create_future())
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.cond:
+                self.waiters.discard(waiter)
+        return self.serial
+
+class FileLock:
+    # A POSIX record lock on the whole file. Unlike a semaphore, the kernel
+    # releases it when the process holding it dies. Threads of one process
+    # share it, so they need a lock of their own on top.
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+class SharedState:
+    HEADER = struct.Struct('<QQQQ')
+    RECORD = struct.Struct('<I')
+    # The change log is folded into a new snapshot once it outgrows both
+    # the snapshot and this many bytes.
+    MIN_COMPACT = 1 << 16
+
+    def __init__(self, state):
+        # A file holding a pickled snapshot of the state, followed by a log
+        # of the changes made since. Its descriptor survives fork(), so
+        # this must be created before the worker processes are.
+        self.file = tempfile.TemporaryFile()
+        self.fd = self.file.fileno()
+        self.lock = FileLock(self.fd)
+        self.epoch = None
+        self.position = 0
+        os.pwrite(self.fd, self.HEADER.pack(0, self.HEADER.size, 0, 0), 0)
+        self.compact(state)
+
+    def _header(self):
+        # Epoch, snapshot offset, snapshot size and log size.
+        return self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))
+
+    def load(self):
+        # Returns the snapshot (if this process has not seen it yet) and
+        # the changes logged since this process last looked.
+        epoch, offset, snapshot_size, log_size = self._header()
+        state = None
+        if epoch != self.epoch:
+            state = pickle.loads(os.pread(self.fd, snapshot_size, offset))
+            self.epoch, self.position = epoch, 0
+        data = os.pread(self.fd, log_size - self.position,
+                        offset + snapshot_size + self.position)
+        self.position = log_size
+        changes, pos = [], 0
+        while pos < len(data):
+            size, = self.RECORD.unpack_from(data, pos)
+            pos += self.RECORD.size
+            changes.extend(pickle.loads(data[pos:pos + size]))
+            pos += size
+        return state, changes
+
+    def append(self, changes, state):
+        # Must follow a load() under the same lock; state is what results
+        # from applying the changes. The header is written last, so that a
+        # failed write leaves the previous contents in effect.
+        epoch, offset, snapshot_size, log_size = self._header()
+        if log_size > max(snapshot_size, self.MIN_COMPACT):
+            self.compact(state)
+            return
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        os.pwrite(self.fd, self.RECORD.pack(len(data)) + data,
+                  offset + snapshot_size + log_size)
+        log_size += self.RECORD.size + len(data)
+        os.pwrite(self.fd, self.HEADER.pack(epoch, offset, snapshot_size,
+                                            log_size), 0)
+        self.position = log_size
+
+    def compact(self, state):
+        epoch, offset, snapshot_size, log_size = self._header()
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        # Place the new snapshot where it does not overlap the current one
+        # or its log.
+        if len(data) <= offset - self.HEADER.size:
+            new_offset = self.HEADER.size
         else:
-            self.queued_range[0] = max(self.queued_range[0],
-                                       idx + 5)
+            new_offset = offset + snapshot_size + log_size
+        os.pwrite(self.fd, data, new_offset)
+        os.pwrite(self.fd, self.HEADER.pack(epoch + 1, new_offset, len(data),
+                                            0), 0)
+        os.ftruncate(self.fd, new_offset + len(data))
+        self.epoch, self.position = epoch + 1, 0
+
+class SlotArchive:
+    HEADER = struct.Struct('<4sHxxQ')
+    MAGIC = b'NUMA'
+    VERSION = 1
+    # Five bytes of digits and one source byte; all-zero records are gaps.
+    RECORD_SIZE = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.base = None
+        self.map = None
+        self._read_header()
 
-        return self.queued.pop(idx, None)
+    def _read_header(self):
+        # The file may be shared with other worker processes, any of which
+        # might have written the header since this one last looked.
+        header = os.pread(self.fd, self.HEADER.size, 0)
+        if len(header) == self.HEADER.size:
+            magic, version, self.base = self.HEADER.unpack(header)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('Not a slot archive: %r' % self.path)
+
+    def _offset(self, index):
+        return self.HEADER.size + (index - self.base) // 5 * self.RECORD_SIZE
+
+    def append(self, index, value, source):
+        # Called with the shared lock held, which serializes the creation
+        # of the header between workers.
+        if self.base is None: self._read_header()
+        if self.base is None:
+            self.base = index
+            os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.VERSION,
+                                                index), 0)
+        elif index < self.base:
+            return
+        record = value.encode('ascii') + bytes((source,))
+        os.pwrite(self.fd, record, self._offset(index))
+
+    def _view(self, end):
+        view = self.map
+        if view is None or len(view) < end:
+            size = os.fstat(self.fd).st_size
+            # Ranges may reach past the records written so far.
+            if size <= (0 if view is None else len(view)): return view
+            # Older mappings are left to the garbage collector, as other
+            # threads might still be reading from them.
+            view = self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        return view
+
+    def get_range(self, start, end):
+        if self.base is None: self._read_header()
+        if self.base is None or end < self.base: return []
+        start = max(start - start % 5, self.base)
+        first = self._offset(start)
+        view = self._view(self._offset(end) + self.RECORD_SIZE)
+        if view is None: return []
+        data = view[first:self._offset(end) + self.RECORD_SIZE]
+        ret = []
+        for pos in range(0, len(data) - self.RECORD_SIZE + 1,
+                         self.RECORD_SIZE):
+            source = data[pos + 5]
+            if source:
+                ret.append((start + pos // self.RECORD_SIZE * 5,
+                            data[pos:pos + 5].decode('ascii'), source))
+        return ret
+
+    def get(self, index):
+        records = self.get_range(index, index)
+        return records[0] if records else None
 
 class NumberSupply:
-    def __init__(self):
+    def __init__(self, key=None, archive=None):
+        if isinstance(key, str): key = key.encode('utf-8')
+        if isinstance(archive, str): archive = SlotArchive(archive)
+        self.key = key
+        self.archive = archive
         self.current = [None, None, None, None]
         self.queue = NumberQueue()
+        # Only writers (slot rotation and uploads) take the lock; readers
+        # use the snapshot, which is replaced wholesale on every change.
         self.lock = threading.RLock()
+        self.snapshot = Snapshot(0, None, None, None, {})
+        self.broadcaster = SlotBroadcaster()
+        self.shared = None
+        self.timer_pid = None
+        self._changes = None
+        # Uploaded values of emitted slots, and the first slot from which
+        # on those are complete.
+        self.uploaded = collections.OrderedDict()
+        self.tracked_since = None
+
+    def share(self):
+        with self.lock:
+            self.shared = SharedState(self._state())
+
+    def _state(self):
+        # Everything the workers must agree on; the remembered uploads are
+        # included so that compaction does not lose them.
+        return (self.current, self.queue, self.uploaded, self.tracked_since)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        begin = time.perf_counter()
+        with self.lock:
+            LOCK_WAIT.observe(time.perf_counter() - begin)
+            if self.shared is None:
+                yield
+                return
+            with self.shared.lock:
+                self._sync()
+                self._changes = []
+                try:
+                    yield
+                    if self._changes:
+                        self.shared.append(self._changes, self._state())
+                except BaseException:
+                    # Start over from the shared copy, so that this process
+                    # never keeps changes the others have not seen.
+                    self.shared.epoch = None
+                    self._sync()
+                    raise
+                finally:
+                    self._changes = None
+
+    def _sync(self):
+        state, changes = self.shared.load()
+        old_index = self.current[0]
+        if state is not None:
+            current, self.queue, self.uploaded, self.tracked_since = state
+            self.current = list(current)
+        for change in changes:
+            if change[0] == 'rotate':
+                for index in change[2]:
+                    self._note_value(index, self.queue.pop(index))
+                self.current = list(change[1])
+            elif change[0] == 'add':
+                for values in change[1]: self.queue.add(values, change[2])
+        if self.current[0] != old_index:
+            self._publish()
+
+    def _note_value(self, index, value):
+        if self.tracked_since is None: self.tracked_since = index
+        if value is None or index % 60 == 0: return
+        self.uploaded[index] = value
+        cutoff = index - UPLOAD_MEMORY
+        while next(iter(self.uploaded)) < cutoff:
+            self.uploaded.popitem(last=False)
+            self.tracked_since = max(self.tracked_since, cutoff)
+
+    def is_settled(self, index):
+        # Whether uploads that replaced slots from index on are known, either
+        # from memory or from the archive.
+        if self.tracked_since is not None and index >= self.tracked_since:
+            return True
+        return (self.archive is not None and self.archive.base is not None
+                and index >= self.archive.base)
+
+    def past_value(self, index):
+        value = self.uploaded.get(index)
+        if value is None and self.key is not None:
+            value = self.derive_value(index)
+        return value
+
+    def _record(self, change):
+        if self._changes is not None: self._changes.append(change)
+
+    def derive_value(self, index):
+        if index % 60 == 0:
+            return self.queue.marker
+        digest = hmac.new(self.key, str(index).encode('ascii'),
+                          hashlib.sha256).digest()
+        return format(int.from_bytes(digest[:8], 'big') % 100000, '05')
 
     def generate_value(self, index):
         v = self.queue.pop(index)
-        if v is None:
-            v = format(RANDOM.randrange(100000), '05')
+        self._note_value(index, v)
+        if v is not None:
+            source = SOURCE_MARKER if index % 60 == 0 else SOURCE_UPLOAD
+        elif self.key is not None:
+            v, source = self.derive_value(index), SOURCE_DERIVED
+        else:
+            v, source = format(RANDOM.randrange(100000), '05'), SOURCE_RANDOM
+        if self.archive is not None:
+            self.archive.append(index, v, source)
         return v
 
     def update_values(self, now):
         next_index = int((now + 2) / 5) * 5
         if self.current[0] == next_index - 10:
+            generated = (next_index,)
             self.current[0] += 5
             self.current[1] = self.current[2]
             self.current[2] = self.generate_value(next_index)
         elif self.current[0] is None or self.current[0] < next_index - 10:
+            generated = (next_index - 5, next_index)
             self.current[0] = next_index - 5
             self.current[1] = self.generate_value(next_index - 5)
             self.current[2] = self.generate_value(next_index)
         else:
             return
         self.current[3] = self.current[0] + 8
+        # Other workers replay the queue pops, but take the values as they
+        # are, as they may be random.
+        self._record(('rotate', tuple(self.current), generated))
+        self._publish()
 
-    def add_values(self, values, now=None):
+    def _publish(self):
+        base_index, value, next_value, refresh_at = self.current
+        self.snapshot = Snapshot(refresh_at, base_index, value, next_value, {
+            base_index: make_slot_response(base_index, value,
+                                           base_index + 8),
+            base_index + 5: make_slot_response(base_index + 5, next_value,
+                                               base_index + 13)
+        })
+        self.broadcaster.publish()
+
+    def refresh(self, now):
+        with self._locked():
+            if self.current[3] is None or now >= self.current[3]:
+                self.update_values(now)
+
+    def _start_timer(self):
+        # Threads do not survive fork(), so every worker starts its own.
         with self.lock:
+            if self.timer_pid == os.getpid(): return
+            self.timer_pid = os.getpid()
+            threading.Thread(target=self._run_timer, daemon=True).start()
+
+    def _run_timer(self):
+        while 1:
+            try:
+                self.refresh(time.time())
+            except Exception:
+                # Readers fall back to refreshing themselves; keep trying
+                # rather than leaving the snapshot to go stale.
+                traceback.print_exc()
+                time.sleep(1)
+                continue
+            time.sleep(max(self.snapshot.refresh_at - time.time(), 0))
+
+    def add_values(self, values, now=None):
+        self.add_batch((values,), now)
+
+    def add_batch(self, messages, now=None):
+        count = sum(map(len, messages))
+        with self._locked():
+            # Checked before anything changes, so a rejected batch leaves
+            # no trace.
+            if len(self.queue.queued) + count > MAX_QUEUED_VALUES:
+                raise QueueFull('Upload queue full')
             if now is None: now = time.time()
             self.update_values(now)
-            self.queue.add(values, self.current[0] + 10)
+            for values in messages:
+                self.queue.add(values, self.current[0] + 10)
+            self._record(('add', messages, self.current[0] + 10))
 
-    def get_value(self, index, now=None):
-        with self.lock:
-            if now is None:
-                now = time.time()
-            if self.current[3] is None or now >= self.current[3]:
-                self.update_values(now)
-            current = tuple(self.current)
+    def _current_snapshot(self, now):
+        if self.timer_pid != os.getpid(): self._start_timer()
+        snapshot = self.snapshot
+        if now >= snapshot.refresh_at:
+            # The timer has not caught up yet.
+            self.refresh(now)
+            snapshot = self.snapshot
+        return snapshot
+
+    def get_response(self, index, now=None):
+        if now is None: now = time.time()
+        return self._current_snapshot(now).responses.get(index)
 
-        base_index = current[0]
+    def follow(self, index):
+        serial = self.broadcaster.serial
+        while 1:
+            now = time.time()
+            snapshot = self._current_snapshot(now)
+            for slot in sorted(snapshot.responses.values()):
+                if slot.index < index: continue
+                yield slot
+                index = slot.index + 5
+            serial = self.broadcaster.wait(serial,
+                                           snapshot.refresh_at - now)
+
+    async def follow_async(self, index):
+        serial = self.broadcaster.serial
+        while 1:
+            now = time.time()
+            snapshot = self._current_snapshot(now)
+            for slot in sorted(snapshot.responses.values()):
+                if slot.index < index: continue
+                yield slot
+                index = slot.index + 5
+            serial = await self.broadcaster.wait_async(
+                serial, snapshot.refresh_at - now)
+
+    def get_range(self, start, end, now=None):
+        if now is None: now = time.time()
+        snapshot = self._current_snapshot(now)
+        base_index = snapshot.index
+        end = min(end, base_index + 5)
+        if self.archive is not None:
+            records = {t: d for t, d, s in self.archive.get_range(start, end)}
+        else:
+            records = {}
+        ret = []
+        for index in range(start + -start % 5, end + 1, 5):
+            value = records.get(index)
+            if value is not None:
+                pass
+            elif index >= base_index:
+                value = snapshot.responses[index].value
+            else:
+                value = self.past_value(index)
+                if value is None: continue
+            ret.append((index, value))
+        return ret
+
+    def get_value(self, index, now=None):
+        if now is None: now = time.time()
+        snapshot = self._current_snapshot(now)
+        base_index = snapshot.index
+        archived = None
+        if index < base_index and self.archive is not None:
+            archived = self.archive.get(index)
         if index == base_index:
             return {'code': 200,
-                    'data': {'t': base_index, 'd': current[1]},
+                    'data': {'t': base_index, 'd': snapshot.value},
                     'expires': base_index + 8}
         elif index == base_index + 5:
             return {'code': 200,
-                    'data': {'t': base_index + 5, 'd': current[2]},
+                    'data': {'t': base_index + 5, 'd': snapshot.next_value},
                     'expires': base_index + 13}
         elif index % 5 != 0:
             return {'code': 404,
                     'text': '404 Not Found',
                     'expires': max(index, now) + 3600}
+        elif archived is not None:
+            return {'code': 200,
+                    'data': {'t': index, 'd': archived[1]},
+                    'expires': now + 86400}
         elif index < base_index:
-            return {'code': 410,
-                    'text': '410 Gone',
-                    'expires': max(index, now) + 3600}
+            value = self.past_value(index)
+            if value is None:
+                return {'code': 410,
+                        'text': '410 Gone',
+                        'expires': max(index, now) + 3600}
+            # Past slots are recomputed from the key unless an upload is
+            # known to have replaced them; those that might have been
+            # replaced unnoticed are not cached for long.
+            if self.is_settled(index):
+                expires = now + 86400
+            else:
+                expires = now + UNSETTLED_MAX_AGE
+            return {'code': 200, 'data': {'t': index, 'd': value},
+                    'expires': expires}
         else:
             return {'code': 404,
                     'text': '404 Not Found',
                     'expires': index - 2}
 
-THE_NUMBERS = NumberSupply()
+class SlotStream:
+    def __init__(self, supply, index, listeners):
+        self.supply = supply
+        self.index = index
+        self.listeners = listeners
+
+    def __iter__(self):
+        for slot in self.supply.follow(self.index):
+            yield b'id: %d\ndata: %s\n\n' % (slot.index, slot.body)
+
+    async def __aiter__(self):
+        async for slot in self.supply.follow_async(self.index):
+            yield b'id: %d\ndata: %s\n\n' % (slot.index, slot.body)
+
+    def close(self):
+        listeners, self.listeners = self.listeners, None
+        if listeners is not None: listeners.release()
+
+class AudioSprite:
+    def __init__(self, directory, pattern='d??.mp3'):
+        self.directory = directory
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.name = None
+        self.sprite = None
+        self.index = None
+
+    def build(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+        chunks, clips, offset, mtime = [], {}, 0, 0
+        for path in paths:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+                mtime = max(mtime, os.fstat(fp.fileno()).st_mtime)
+            name = os.path.splitext(os.path.basename(path))[0]
+            clips[name] = [offset, len(data)]
+            chunks.append(data)
+            offset += len(data)
+        body = b''.join(chunks)
+        # The content hash in the URL allows caching the sprite forever.
+        name = hashlib.sha1(body).hexdigest()[:16] + '.mp3'
+        index = json.dumps({'url': 'sprite/' + name, 'clips': clips},
+                           sort_keys=True).encode('ascii')
+        self.name = name
+        self.index = wsgif.StaticEntry(
+            '/sprite.json', index, mtime, 'application/json', compress=True,
+            headers=[('Cache-Control', 'no-cache')])
+        # Assigned last, as readers check this attribute without locking.
+        self.sprite = wsgif.StaticEntry(
+            '/sprite/' + name, body, mtime, 'audio/mpeg',
+            headers=[('Cache-Control', 'max-age=31536000, immutable')])
+
+    def get(self):
+        if self.sprite is None:
+            with self.lock:
+                if self.sprite is None: self.build()
+        return self
+
+THE_NUMBERS = NumberSupply(key=os.environ.get('NUMBERS_KEY'),
+                           archive=os.environ.get('NUMBERS_ARCHIVE'))
+
+METRICS.gauge('numbers_queue_depth', 'Uploaded values waiting for a slot',
+              function=lambda: len(THE_NUMBERS.queue.queued))
+
+AUDIO_SPRITE = AudioSprite(os.path.join(THIS_DIR, 'www'))
+
+MAX_RANGE = 17280
+MAX_BULK_LINE = 128
+MAX_BULK_MESSAGES = 10000
+MAX_STREAM_LISTENERS = 1000
+
+# Every listener on the threaded server holds a thread for its lifetime.
+STREAM_LISTENERS = threading.BoundedSemaphore(MAX_STREAM_LISTENERS)
 
 route = wsgif.RouteBuilder()
 
@@ -150,35 +748,161 @@ def handle_data(app):
         index = int(raw_index)
     except ValueError:
         return app.send_code(400, '400 Bad Request')
+    # Lets clients estimate their clock offset; slots are published two
+    # seconds before they start.
+    app.add_header('X-Server-Time', '%.3f' % now)
+    cached = THE_NUMBERS.get_response(index, now=now)
+    if cached is not None:
+        LOOKUPS.labels('200').inc()
+        # Clamped, as the clock may have stepped back since the slot was
+        # published.
+        age = min(max(int(cached.expires - now), 0), len(cached.headers) - 1)
+        headers = cached.headers[age]
+        if app.etag_matches(cached.etag):
+            return app.send_response('304 Not Modified', headers[2:], b'')
+        return app.send_response('200 OK', headers, cached.body)
     result = THE_NUMBERS.get_value(index, now=now)
+    LOOKUPS.labels(str(result['code'])).inc()
     max_age = max(int(result['expires'] - now), 0)
+    app.add_header('Expires', wsgif.format_http_date(result['expires']))
     app.add_header('Cache-Control', 'max-age={}'.format(max_age))
     if result['code'] == 200:
+        etag = '"{t}-{d}"'.format(**result['data'])
+        app.add_header('ETag', etag)
+        if app.etag_matches(etag):
+            return app.send_response('304 Not Modified', (), b'')
         body = urllib.parse.urlencode(result['data'])
         return app.send_code(result['code'], body,
                              content_type='application/x-www-form-urlencoded')
     else:
         return app.send_code(result['code'], result['text'])
 
+@route('/data/stream')
+def handle_data_stream(app):
+    raw_index = app.environ.get('HTTP_LAST_EVENT_ID')
+    if raw_index:
+        offset = 5
+    else:
+        raw_index, offset = app.query_vars.get('t'), 0
+    if not raw_index:
+        raw_index = int(time.time() / 5) * 5
+    try:
+        index = int(raw_index) + offset
+    except ValueError:
+        return app.send_code(400, '400 Bad Request')
+    if not STREAM_LISTENERS.acquire(blocking=False):
+        app.add_header('Retry-After', '5')
+        return app.send_code(503)
+    app.start_response('200 OK', [('Content-Type', 'text/event-stream'),
+                                  ('Cache-Control', 'no-cache')])
+    return SlotStream(THE_NUMBERS, index, STREAM_LISTENERS)
+
+@route('/data/range')
+def handle_data_range(app):
+    try:
+        start = int(app.query_vars['from'])
+        end = int(app.query_vars.get('to', start + 5 * (MAX_RANGE - 1)))
+    except (KeyError, ValueError):
+        return app.send_code(400, '400 Bad Request')
+    end = min(end, start + 5 * (MAX_RANGE - 1))
+    now = time.time()
+    records = THE_NUMBERS.get_range(start, end, now=now)
+    # Ranges reaching into the current slots may still grow.
+    if end >= int(now / 5) * 5 - 5:
+        app.add_header('Cache-Control', 'max-age=0')
+    elif not THE_NUMBERS.is_settled(start):
+        app.add_header('Cache-Control',
+                       'max-age={}'.format(UNSETTLED_MAX_AGE))
+    else:
+        app.add_header('Cache-Control', 'max-age=86400')
+    body = ''.join(urllib.parse.urlencode({'t': t, 'd': d}) + '\n'
+                   for t, d in records)
+    return app.send_code(200, body)
+
 @route('/data', method='POST')
 def handle_data_post(app):
     body = app.request_body.read(128)
     if len(body) >= 128:
+        UPLOADS.labels('single', 'rejected').inc()
         return app.send_code(400, '400 Bad Request')
     raw_fields = urllib.parse.parse_qs(body.decode('utf-8', errors='replace'))
     fields = {k: v[-1] for k, v in raw_fields.items()}
     m = VALID_UPLOAD.match(fields.get('d', ''))
     if not m:
+        UPLOADS.labels('single', 'rejected').inc()
         return app.send_code(400, '400 Bad Request')
-    THE_NUMBERS.add_values(m.group(0).split())
+    values = m.group(0).split()
+    try:
+        THE_NUMBERS.add_values(values)
+    except QueueFull:
+        UPLOADS.labels('single', 'rejected').inc()
+        app.add_header('Retry-After', '300')
+        return app.send_code(503)
+    UPLOADS.labels('single', 'accepted').inc()
+    UPLOADED_VALUES.inc(len(values))
     return app.send_code(200, '200 OK')
 
+@route('/data/bulk', method='POST')
+def handle_data_bulk(app):
+    if app.request_body.remaining is None:
+        UPLOADS.labels('bulk', 'rejected').inc()
+        return app.send_code(411)
+    reader = io.BufferedReader(app.request_body)
+    messages, lineno = [], 0
+    while 1:
+        line = reader.readline(MAX_BULK_LINE + 1)
+        if not line: break
+        lineno += 1
+        if len(line) > MAX_BULK_LINE:
+            UPLOADS.labels('bulk', 'rejected').inc()
+            return app.send_code(400, '400 Bad Request: line too long')
+        text = line.decode('ascii', errors='replace')
+        if not text.strip(): continue
+        m = VALID_UPLOAD.match(text)
+        if not m:
+            UPLOADS.labels('bulk', 'rejected').inc()
+            return app.send_code(400, '400 Bad Request: invalid line {}'
+                                      .format(lineno))
+        messages.append(m.group(0).split())
+        if len(messages) > MAX_BULK_MESSAGES:
+            UPLOADS.labels('bulk', 'rejected').inc()
+            return app.send_code(413)
+    try:
+        THE_NUMBERS.add_batch(messages)
+    except QueueFull:
+        UPLOADS.labels('bulk', 'rejected').inc()
+        app.add_header('Retry-After', '300')
+        return app.send_code(503)
+    UPLOADS.labels('bulk', 'accepted').inc()
+    UPLOADED_VALUES.inc(sum(map(len, messages)))
+    return app.send_code(200, '200 OK')
+
+@route('/metrics')
+def handle_metrics(app):
+    return app.send_code(200, METRICS.render(),
+                         content_type='text/plain; version=0.0.4; '
+                                      'charset=utf-8')
+
+@route('/sprite.json')
+def handle_sprite_index(app):
+    return app.send_entry(AUDIO_SPRITE.get().index)
+
+@route('/sprite/*')
+def handle_sprite(app):
+    sprite = AUDIO_SPRITE.get()
+    if app.path != '/' + sprite.name:
+        return app.send_code(404)
+    return app.send_entry(sprite.sprite)
+
 @route('/*')
 def handle_statics(app):
     return app.send_static(app.path)
 
 route.fallback(route.fixed(404))
 
-application = route.build_wsgi(static_root=os.path.join(THIS_DIR, 'www'))
+application = route.build_wsgi(static_root=os.path.join(THIS_DIR, 'www'),
+                               static_cache=wsgif.StaticCache(),
+                               metrics=METRICS)
 
-if __name__ == '__main__': wsgif.run_app(application)
+if __name__ == '__main__':
+    wsgif.run_app(application, before_fork=THE_NUMBERS.share)
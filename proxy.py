@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+import os, time
+import collections
+import concurrent.futures
+import http.client
+import threading
+import urllib.parse
+import wsgiref.util
+import wsgif
+
+DEFAULT_UPSTREAM = 'http://localhost:8080'
+
+# Freshness of static assets whose upstream response says nothing about it.
+STATIC_MAX_AGE = 60
+MAX_STATIC_SIZE = 1 << 20
+CHUNK_SIZE = 8192
+
+# Regenerated by this server.
+GENERATED_HEADERS = frozenset(('date', 'server'))
+# Meaningless once cached; send_cached() supplies current values.
+DROPPED_HEADERS = GENERATED_HEADERS | frozenset(('age', 'x-server-time'))
+NOT_MODIFIED_DROPPED = frozenset(('content-type', 'content-length'))
+
+METRICS = wsgif.Metrics()
+CACHE_LOOKUPS = METRICS.counter('proxy_cache_lookups_total',
+                                'Cache lookups by cache and result',
+                                ('cache', 'result'))
+UPSTREAM_REQUESTS = METRICS.counter('proxy_upstream_requests_total',
+                                    'Requests sent upstream by kind and '
+                                    'status', ('kind', 'status'))
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', 'status headers body etag fetched offset')
+
+def response_headers(headers, dropped=DROPPED_HEADERS):
+    return [(n, v) for n, v in headers
+            if not wsgiref.util.is_hop_by_hop(n) and
+               n.lower() not in dropped]
+
+def cache_expiry(resp, now, default=None):
+    # None means that the response must not be stored at all; an expiry
+    # in the past keeps it around for revalidation only.
+    directives = {}
+    for item in (resp.getheader('Cache-Control') or '').split(','):
+        name, _, value = item.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    elif 'no-cache' in directives:
+        return now
+    try:
+        age = int(resp.getheader('Age') or 0)
+    except ValueError:
+        age = 0
+    for name in ('s-maxage', 'max-age'):
+        try:
+            return now + max(int(directives[name]) - age, 0)
+        except (KeyError, ValueError):
+            pass
+    return None if default is None else now + default
+
+class Upstream:
+    def __init__(self, url, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle: return self.idle.pop()
+        if self.https:
+            return http.client.HTTPSConnection(self.netloc,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def release(self, conn, resp):
+        # A response that is still open would make the next request on the
+        # connection fail.
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            self.idle.append(conn)
+
+    def open(self, method, path, body=None, headers=None):
+        # The response body is left unread; pass the connection and the
+        # response to release() once it has been consumed.
+        while 1:
+            conn = self._acquire()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, self.prefix + path, body=body,
+                             headers=headers or {})
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # An idle connection might have been closed by the server
+                # in the meantime; retry safe requests on a fresh one.
+                if reused and method in ('GET', 'HEAD'): continue
+                raise
+
+    def fetch(self, kind, path, headers=None):
+        try:
+            conn, resp = self.open('GET', path, headers=headers)
+            try:
+                body = resp.read()
+            except BaseException:
+                conn.close()
+                raise
+        except (http.client.HTTPException, OSError):
+            UPSTREAM_REQUESTS.labels(kind, 'error').inc()
+            raise
+        UPSTREAM_REQUESTS.labels(kind, str(resp.status)).inc()
+        self.release(conn, resp)
+        return resp, body
+
+class UpstreamBody:
+    def __init__(self, upstream, conn, resp):
+        self.upstream = upstream
+        self.conn = conn
+        self.resp = resp
+
+    def __iter__(self):
+        while 1:
+            # read1() returns whatever has arrived, so that event streams
+            # are relayed as they come.
+            chunk = self.resp.read1(CHUNK_SIZE)
+            if not chunk: break
+            yield chunk
+        # read1() may leave the response open after its last byte; read()
+        # closes it once nothing is left.
+        self.resp.read()
+        conn, self.conn = self.conn, None
+        if conn is not None: self.upstream.release(conn, self.resp)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class ResponseCache:
+    def __init__(self, name, fetch, max_entries=4096):
+        self.name = name
+        # Called as fetch(key, stale) with the expired value, if any, and
+        # returns a (value, expiry) pair; see cache_expiry().
+        self.fetch = fetch
+        self.max_entries = max_entries
+        self.entries = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _store(self, key, entry, now):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        if len(self.entries) <= self.max_entries: return
+        for k in [k for k, e in self.entries.items() if e[1] <= now]:
+            del self.entries[k]
+        # Dictionaries keep insertion order, so this drops the oldest.
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    def get(self, key, now=None):
+        if now is None: now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now < entry[1]:
+            CACHE_LOOKUPS.labels(self.name, 'hit').inc()
+            return entry[0]
+        # Concurrent misses for the same key wait for a single fetch.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now < entry[1]:
+                CACHE_LOOKUPS.labels(self.name, 'hit').inc()
+                return entry[0]
+            future = self.pending.get(key)
+            leader = future is None
+            if leader:
+                future = self.pending[key] = concurrent.futures.Future()
+        if not leader:
+            CACHE_LOOKUPS.labels(self.name, 'coalesced').inc()
+            return future.result()
+        CACHE_LOOKUPS.labels(self.name, 'miss').inc()
+        try:
+            value, expires = self.fetch(key, entry and entry[0])
+        except BaseException as exc:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(exc)
+            raise
+        with self.lock:
+            del self.pending[key]
+            if expires is not None:
+                self._store(key, (value, expires), time.time())
+        future.set_result(value)
+        return value
+
+UPSTREAM = Upstream(os.environ.get('NUMBERS_UPSTREAM', DEFAULT_UPSTREAM))
+
+def fetch_slot(index, stale):
+    sent = time.time()
+    resp, body = UPSTREAM.fetch('data', '/data?t=%d' % index)
+    received = time.time()
+    try:
+        # Relative to the midpoint of the exchange, so that it can be
+        # re-applied when serving from the cache.
+        offset = (float(resp.getheader('X-Server-Time')) -
+                  (sent + received) / 2)
+    except (TypeError, ValueError):
+        offset = None
+    cached = CachedResponse('%d %s' % (resp.status, resp.reason),
+                            response_headers(resp.getheaders()), body,
+                            resp.getheader('ETag'), received, offset)
+    if resp.status >= 500: return cached, None
+    return cached, cache_expiry(resp, received)
+
+def fetch_static(path, stale):
+    headers = {}
+    if isinstance(stale, wsgif.StaticEntry):
+        headers['If-Modified-Since'] = wsgif.format_http_date(stale.mtime)
+    resp, body = UPSTREAM.fetch(
+        'static', urllib.parse.quote(path, encoding='latin-1'), headers)
+    now = time.time()
+    if resp.status == 304 and headers:
+        return stale, cache_expiry(resp, now, STATIC_MAX_AGE)
+    elif resp.status != 200 or len(body) > MAX_STATIC_SIZE:
+        cached = CachedResponse('%d %s' % (resp.status, resp.reason),
+                                response_headers(resp.getheaders()), body,
+                                None, now, None)
+        if resp.status != 200 and resp.status < 500:
+            return cached, cache_expiry(resp, now)
+        return cached, None
+    try:
+        mtime = wsgif.parse_http_date(resp.getheader('Last-Modified'))
+    except (TypeError, ValueError):
+        mtime = now
+    mime = resp.getheader('Content-Type')
+    compress = mime is not None and mime.startswith(wsgif.COMPRESSIBLE_TYPES)
+    extra = [('Cache-Control', resp.getheader('Cache-Control'))]
+    entry = wsgif.StaticEntry(path, body, mtime, mime, compress,
+                              [h for h in extra if h[1] is not None])
+    return entry, cache_expiry(resp, now, STATIC_MAX_AGE)
+
+SLOTS = ResponseCache('data', fetch_slot)
+STATICS = ResponseCache('static', fetch_static)
+
+def forward(environ, start_response):
+    method = environ['REQUEST_METHOD']
+    path = urllib.parse.quote(environ.get('PATH_INFO') or '/',
+                              encoding='latin-1')
+    if environ.get('QUERY_STRING'): path += '?' + environ['QUERY_STRING']
+    headers = {}
+    for key, value in environ.items():
+        if not key.startswith('HTTP_') or key == 'HTTP_HOST': continue
+        name = key[5:].replace('_', '-').title()
+        if not wsgiref.util.is_hop_by_hop(name): headers[name] = value
+    remote = environ.get('REMOTE_ADDR')
+    if remote:
+        headers['X-Forwarded-For'] = ', '.join(
+            filter(None, (headers.get('X-Forwarded-For'), remote)))
+    body = None
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        length = -1
+    if length >= 0:
+        body = environ['wsgi.input'].read(length)
+    elif method in ('POST', 'PUT'):
+        start_response('411 Length Required',
+                       [('Content-Type', 'text/plain; charset=utf-8'),
+                        ('Content-Length', '19')])
+        return [b'411 Length Required']
+    try:
+        conn, resp = UPSTREAM.open(method, path, body, headers)
+    except (http.client.HTTPException, OSError):
+        UPSTREAM_REQUESTS.labels('forward', 'error').inc()
+        start_response('502 Bad Gateway',
+                       [('Content-Type', 'text/plain; charset=utf-8'),
+                        ('Content-Length', '15')])
+        return [b'502 Bad Gateway']
+    UPSTREAM_REQUESTS.labels('forward', str(resp.status)).inc()
+    start_response('%d %s' % (resp.status, resp.reason),
+                   response_headers(resp.getheaders(), GENERATED_HEADERS))
+    return UpstreamBody(UPSTREAM, conn, resp)
+
+def send_cached(app, cached):
+    now = time.time()
+    app.add_header('Age', str(max(int(now - cached.fetched), 0)))
+    if cached.offset is not None:
+        app.add_header('X-Server-Time', '%.3f' % (now + cached.offset))
+    if cached.etag is not None and app.etag_matches(cached.etag):
+        return app.send_response('304 Not Modified',
+                                 [h for h in cached.headers
+                                  if h[0].lower() not in
+                                     NOT_MODIFIED_DROPPED], b'')
+    return app.send_response(cached.status, cached.headers, cached.body)
+
+route = wsgif.RouteBuilder()
+
+FORWARD = route.wsgi(forward)
+
+@route('/data')
+def handle_data(app):
+    try:
+        index = int(app.query_vars['t'])
+    except (KeyError, ValueError):
+        # The current slot depends on the upstream's clock.
+        return FORWARD(app)
+    try:
+        cached = SLOTS.get(index)
+    except (http.client.HTTPException, OSError):
+        return app.send_code(502)
+    return send_cached(app, cached)
+
+route('/data/*', FORWARD)
+
+@route('/metrics')
+def handle_metrics(app):
+    return app.send_code(200, METRICS.render(),
+                         content_type='text/plain; version=0.0.4; '
+                                      'charset=utf-8')
+
+@route('/*')
+def handle_statics(app):
+    if app.query: return FORWARD(app)
+    try:
+        cached = STATICS.get(app.path)
+    except (http.client.HTTPException, OSError):
+        return app.send_code(502)
+    if isinstance(cached, wsgif.StaticEntry):
+        return app.send_entry(cached)
+    return send_cached(app, cached)
+
+route.fallback(FORWARD)
+
+application = route.build_wsgi(metrics=METRICS)
+
+if __name__ == '__main__':
+    wsgif.run_app(application)
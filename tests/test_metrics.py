@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+import wsgif
+
+class MetricsTest(unittest.TestCase):
+    def make_metrics(self):
+        metrics = wsgif.Metrics()
+        self.hits = metrics.counter('hits_total', 'Hits', ('kind',))
+        self.busy = metrics.gauge('busy', 'Busy')
+        self.sizes = metrics.histogram('sizes', 'Sizes', buckets=(10, 100))
+        return metrics
+
+    def test_workers_are_added_up(self):
+        metrics = self.make_metrics()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        metrics.share(directory.name)
+        pids = []
+        for w in range(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.hits.labels('a').inc(w + 1)
+                    self.sizes.observe(50)
+                    self.busy.inc()
+                    metrics.publish()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.hits.labels('b').inc()
+        self.busy.inc()
+        lines = metrics.render().splitlines()
+        self.assertIn('hits_total{kind="a"} 6', lines)
+        self.assertIn('hits_total{kind="b"} 1', lines)
+        self.assertIn('sizes_bucket{le="100"} 3', lines)
+        self.assertIn('sizes_count 3', lines)
+        # The gauges of the exited workers are gone.
+        self.assertIn('busy 1', lines)
+
+    def test_unshared(self):
+        metrics = self.make_metrics()
+        self.hits.labels('a').inc(2)
+        self.assertIn('hits_total{kind="a"} 2', metrics.render().splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import io
+import socket
+import threading
+import unittest
+import wsgiref.util
+
+import proxy
+import wsgif
+
+def echo(environ, start_response):
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length)
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body))),
+                              ('X-Server-Time', '1000000.000')])
+    return [body]
+
+class ForwardTest(unittest.TestCase):
+    def setUp(self):
+        sock = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        server = wsgif.AsyncServer(echo, '127.0.0.1', 0, 4)
+        threading.Thread(target=server.serve_forever, args=(sock,),
+                         daemon=True).start()
+        upstream = proxy.Upstream('http://127.0.0.1:%d' %
+                                  sock.getsockname()[1])
+        original, proxy.UPSTREAM = proxy.UPSTREAM, upstream
+        self.addCleanup(setattr, proxy, 'UPSTREAM', original)
+
+    def request(self, method, path, body=b''):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        wsgiref.util.setup_testing_defaults(environ)
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append((status, dict(headers)))
+        result = proxy.application(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'): result.close()
+        return started[0][0], started[0][1], body
+
+    def test_posts_reuse_connection(self):
+        for value in (b'd=11111', b'd=22222'):
+            status, headers, body = self.request('POST', '/data', value)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(body, value)
+        self.assertEqual(len(proxy.UPSTREAM.idle), 1)
+
+    def test_server_time_forwarded(self):
+        status, headers, body = self.request('GET', '/data')
+        self.assertEqual(headers['X-Server-Time'], '1000000.000')
+
+if __name__ == '__main__':
+    unittest.main()
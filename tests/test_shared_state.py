@@ -0,0 +1,104 @@
+import os, time
+import copy
+import threading
+import unittest
+
+import main
+
+NOW = 1000000
+
+def replay(shared):
+    # Rebuilds the state from the file alone, as a fresh worker would.
+    supply = main.NumberSupply(key=b'test')
+    supply.shared = shared
+    shared.epoch = None
+    with supply._locked():
+        pass
+    return supply
+
+class SharedStateTest(unittest.TestCase):
+    def make_supply(self):
+        supply = main.NumberSupply(key=b'test')
+        supply.refresh(NOW)
+        supply.share()
+        return supply
+
+    def test_workers_converge(self):
+        supply = self.make_supply()
+        pids = []
+        for w in range(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for i in range(200):
+                        supply.add_values(['%05d' % (w * 1000 + i)],
+                                          now=NOW + i // 50 * 5)
+                    supply.add_batch([['AAAAA'] * 11] * 10000, now=NOW + 20)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        supply.refresh(NOW + 20)
+        # The full batches must have forced at least one compaction.
+        self.assertGreater(supply.shared.epoch, 1)
+        self.assertEqual(len(supply.queue.queued), 3 * (200 + 110000) - 3)
+        other = replay(supply.shared)
+        self.assertEqual(other.queue.queued, supply.queue.queued)
+        self.assertEqual(other.current, supply.current)
+
+    def test_log_is_incremental(self):
+        supply = self.make_supply()
+        supply.add_values(['11111'], now=NOW)
+        epoch = supply.shared.epoch
+        supply.add_values(['22222'], now=NOW)
+        self.assertEqual(supply.shared.epoch, epoch)
+        self.assertEqual(sorted(replay(supply.shared).queue.queued.values()),
+                         ['11111', '22222'])
+
+    def test_failed_store_rolls_back(self):
+        supply = self.make_supply()
+        supply.add_values(['11111'], now=NOW)
+        before = dict(supply.queue.queued)
+        def fail(changes, state):
+            raise OSError('disk full')
+        supply.shared.append = fail
+        with self.assertRaises(OSError):
+            supply.add_values(['22222'], now=NOW)
+        self.assertEqual(supply.queue.queued, before)
+
+    def test_uploads_survive_compaction(self):
+        a = self.make_supply()
+        b = main.NumberSupply(key=b'test')
+        b.shared = copy.copy(a.shared)
+        b.shared.epoch = None
+        b.refresh(NOW)
+        a.add_values(['11111'], now=NOW)
+        for t in range(NOW, NOW + 60, 5):
+            a.refresh(t + 3)
+        index, = a.uploaded
+        # Enough changes that b only ever sees the compacted snapshot.
+        while a.shared.epoch == b.shared.epoch:
+            a.add_batch([['AAAAA']] * 1000, now=NOW + 60)
+        now = NOW + 120
+        for supply in (a, b):
+            result = supply.get_value(index, now=now)
+            self.assertEqual(result['data']['d'], '11111')
+            self.assertEqual(result['expires'], now + 86400)
+
+    def test_lock_released_when_owner_dies(self):
+        supply = self.make_supply()
+        pid = os.fork()
+        if pid == 0:
+            supply.shared.lock.__enter__()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        acquired = threading.Event()
+        def acquire():
+            with supply.shared.lock:
+                acquired.set()
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertTrue(acquired.wait(5))
+
+if __name__ == '__main__':
+    unittest.main()
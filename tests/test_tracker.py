@@ -0,0 +1,67 @@
+import io
+import os
+import tempfile
+import unittest
+
+import tracker
+
+ENDPOINTS = [tracker.AsyncEndpoint('http://%s:8080/data' % host)
+             for host in ('a', 'b', 'c')]
+
+class MergeMirrorsTest(unittest.TestCase):
+    def test_all_agree(self):
+        self.assertEqual(
+            tracker.merge_mirrors(5, ENDPOINTS, ['12345'] * 3),
+            (5, '12345', None))
+
+    def test_one_error(self):
+        self.assertEqual(
+            tracker.merge_mirrors(5, ENDPOINTS,
+                                  ['12345', 'error: timed out', '12345']),
+            (5, '12345', 'missing from b:8080'))
+
+    def test_disagreement(self):
+        self.assertEqual(
+            tracker.merge_mirrors(5, ENDPOINTS,
+                                  ['12345', '54321', '12345']),
+            (5, '12345', 'mirrors disagree: b:8080=54321'))
+
+    def test_all_errors(self):
+        self.assertEqual(
+            tracker.merge_mirrors(5, ENDPOINTS, ['error: timed out'] * 3),
+            (5, None, 'error: timed out'))
+
+class RecordingTest(unittest.TestCase):
+    # The first byte of this timestamp in the binary format is '{'.
+    RECORDS = [(1792348795, '12345', None),
+               (1792348800, None, 'error: timed out'),
+               (1792348805, '54321', 'mirrors disagree: b:8080=12345')]
+
+    def round_trip(self, fmt):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'log')
+        # Two runs appending to the same file.
+        for records in (self.RECORDS[:1], self.RECORDS[1:]):
+            tracker.do_record(iter(records), tracker.RecordSink(path, fmt))
+        with open(path, 'rb') as fp:
+            return list(tracker.read_records(fp))
+
+    def test_binary(self):
+        self.assertEqual(self.round_trip('binary'), [
+            (1792348795, '12345', None),
+            (1792348800, None, 'error: recorded'),
+            (1792348805, '54321', 'mirrors disagree')])
+
+    def test_jsonl(self):
+        self.assertEqual(self.round_trip('jsonl'), self.RECORDS)
+
+    def test_csv(self):
+        self.assertEqual(self.round_trip('csv'), self.RECORDS)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            tracker.read_records(io.BytesIO(b'\x80\x73\xd5\x6a\0\0\0\0'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,42 @@
 
 import sys, os, time
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import csv
 import datetime
-import urllib.parse, urllib.request, urllib.error
+import io
+import json
+import threading
+import http.client
+import signal
+import ssl
+import struct
+import urllib.parse
 
 from main import VALID_UPLOAD
 
 DEFAULT_URL = 'https://31337.leet.nu/data'
 
+BATCH_SIZE = 720
+PARALLEL_FETCHES = 8
+
+# Slots are published this many seconds before they start; fetches are
+# aimed at FETCH_MARGIN seconds after that (by the server's clock).
+PUBLISH_LEAD = 2
+FETCH_MARGIN = 0.25
+CALIBRATION_SAMPLES = 3
+# Mirrors that have not answered this many seconds after being asked for
+# a slot are reported as failed, so that they cannot hold up the others.
+SLOT_DEADLINE = 5
+
+# t, status and the five characters of the slot (NUL-padded if missing),
+# following a file header of BINARY_MAGIC, which ends in a version byte.
+BINARY_MAGIC = b'NUMR\x01'
+BINARY_RECORD = struct.Struct('<qB5s')
+STATUS_OK, STATUS_ERROR, STATUS_DISAGREE = range(3)
+
 def resolve_color(param, stream=None):
     if isinstance(param, str):
         param = {'never': False, 'always': True, 'auto': None}[param.lower()]
@@ -21,13 +50,103 @@ def resolve_color(param, stream=None):
         return False
     return bool(param)
 
-def request(url, post=None):
-    try:
-        with urllib.request.urlopen(url, data=post) as resp:
-            body = resp.read()
-            return resp.status, body.decode('utf-8')
-    except urllib.error.HTTPError as exc:
-        return exc.status, exc.fp.read().decode('utf-8')
+class ServerClock:
+    # Estimates the offset of a server's clock from its X-Server-Time
+    # header. Of the recent samples, the one with the shortest round trip
+    # is trusted, as it bounds the error most tightly.
+    def __init__(self, samples=8):
+        self.samples = collections.deque(maxlen=samples)
+        self.offset = 0.0
+        self.rtt = None
+
+    def observe(self, sent, received, header):
+        if header is None: return
+        try:
+            server_time = float(header)
+        except ValueError:
+            return
+        self.samples.append((received - sent,
+                             server_time - (sent + received) / 2))
+        self.rtt, self.offset = min(self.samples)
+
+    def now(self):
+        return time.time() + self.offset
+
+    def fetch_delay(self, index):
+        # Seconds to wait before requesting the given slot, so that the
+        # request arrives just after it has been published.
+        if self.rtt is None:
+            # Without an estimate, allow for some clock skew.
+            return max(index - 1 - time.time(), 0)
+        return max(index - PUBLISH_LEAD + FETCH_MARGIN - self.offset -
+                   self.rtt / 2 - time.time(), 0)
+
+class ConnectionPool:
+    def __init__(self, timeout=30, max_redirects=5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def _acquire(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns: return conns.pop()
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def _exchange(self, key, method, path, post):
+        headers = {}
+        if post is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        while 1:
+            conn = self._acquire(key)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body=post, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # An idle connection might have been closed by the server
+                # in the meantime; retry safe requests on a fresh one.
+                if reused and method == 'GET': continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return resp, body
+
+    def request(self, url, post=None, clock=None):
+        method = 'GET' if post is None else 'POST'
+        for i in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query: path += '?' + parts.query
+            sent = time.time()
+            resp, body = self._exchange((parts.scheme, parts.netloc), method,
+                                        path, post)
+            if clock is not None:
+                clock.observe(sent, time.time(),
+                              resp.getheader('X-Server-Time'))
+            location = resp.getheader('Location')
+            if method != 'GET' or resp.status not in (301, 302, 303, 307,
+                                                      308) or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+        return resp.status, body.decode('utf-8')
+
+POOL = ConnectionPool()
+
+def request(url, post=None, clock=None):
+    return POOL.request(url, post, clock)
 
 def highlight(text, hlcode, color=True):
     return f'\033[{hlcode}m{text}\033[0m' if color else text
@@ -47,19 +166,96 @@ def format_text(text, note, color=False):
         hlcode = '1;33'
     elif note.startswith('repeated'):
         hlcode = '32'
+    elif note.startswith('mirrors disagree'):
+        hlcode = '1;31'
     else:
         hlcode = '1'
     return highlight(text, hlcode)
 
-def track(base_url):
-    ts = None
+def classify(ts, data):
+    if ts % 60 == 0:
+        return 'sync word' if data == '31337' else 'wat?!'
+    elif not data.isdigit():
+        return 'letters'
+    elif data.count(data[0]) == len(data):
+        return 'repeated ' + data[0]
+    else:
+        return None
+
+def slot_url(base_url, ts):
+    return urllib.parse.urljoin(base_url, '?t=' + str(ts))
+
+def fetch_range(base_url, start, end):
+    query = urllib.parse.urlencode({'from': start, 'to': end})
+    status, body = request(base_url.rstrip('/') + '/range?' + query)
+    if status != 200:
+        return None
+    ret = {}
+    for line in body.splitlines():
+        params = urllib.parse.parse_qs(line)
+        ret[int(params['t'][0])] = params['d'][0]
+    return ret
+
+def fetch_parallel(base_url, slots):
+    def fetch(ts):
+        status, body = request(slot_url(base_url, ts))
+        if status != 200:
+            return 'error: {}'.format(body)
+        return urllib.parse.parse_qs(body)['d'][0]
+    with concurrent.futures.ThreadPoolExecutor(PARALLEL_FETCHES) as pool:
+        return dict(zip(slots, pool.map(fetch, slots)))
+
+def catch_up(base_url, start, end):
+    batches = True
+    for chunk_start in range(start, end + 1, 5 * BATCH_SIZE):
+        slots = range(chunk_start, min(chunk_start + 5 * BATCH_SIZE, end + 5),
+                      5)
+        results = None
+        if batches:
+            results = fetch_range(base_url, slots[0], slots[-1])
+            # Servers without a range endpoint are asked slot by slot.
+            if results is None: batches = False
+        if results is None:
+            results = fetch_parallel(base_url, slots)
+        for ts in slots:
+            data = results.get(ts, 'error: missing')
+            if data.startswith('error: '):
+                yield (ts, None, data)
+            else:
+                yield (ts, data, classify(ts, data))
+
+def calibrate(base_url, clock):
+    for i in range(CALIBRATION_SAMPLES):
+        try:
+            request(base_url, clock=clock)
+        except (http.client.HTTPException, OSError):
+            pass
+
+def track(base_url, start=None, clock=None):
+    if clock is None: clock = ServerClock()
+    calibrate(base_url, clock)
+    ts = None if start is None else start - start % 5
+    retried = False
     while 1:
-        now = time.time()
+        now = clock.now()
+        live = int(now / 5) * 5
+        if ts is not None and ts < live:
+            yield from catch_up(base_url, ts, live)
+            ts = live + 5
+            time.sleep(clock.fetch_delay(ts))
+            continue
         if ts is not None:
-            url = urllib.parse.urljoin(base_url, '?t=' + str(ts))
+            url = slot_url(base_url, ts)
         else:
             url = base_url
-        status, body = request(url)
+        status, body = request(url, clock=clock)
+        if status == 404 and ts is not None and not retried:
+            # Too early, presumably because the clock estimate was off;
+            # it has been refined by now.
+            retried = True
+            time.sleep(max(clock.fetch_delay(ts), FETCH_MARGIN))
+            continue
+        retried = False
         if status != 200:
             yield (int(now), None, 'error: {}'.format(body))
             if ts is None:
@@ -70,28 +266,194 @@ def track(base_url):
         body_params = urllib.parse.parse_qs(body)
         ts = int(body_params['t'][0])
         data = body_params['d'][0]
-        if ts % 60 == 0:
-            note = 'sync word' if data == '31337' else 'wat?!'
-        elif not data.isdigit():
-            note = 'letters'
-        elif data.count(data[0]) == len(data):
-            note = 'repeated ' + data[0]
-        else:
-            note = None
-        yield (ts, data, note)
-        time.sleep(max(ts + 4 - time.time(), 0))
+        yield (ts, data, classify(ts, data))
         ts += 5
+        time.sleep(clock.fetch_delay(ts))
+
+class AsyncEndpoint:
+    # A single keep-alive connection to one server, for use from asyncio.
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url
+        self.parts = urllib.parse.urlsplit(base_url)
+        self.timeout = timeout
+        self.conn = None
+        self.clock = ServerClock()
+
+    async def _connect(self):
+        https = self.parts.scheme == 'https'
+        port = self.parts.port or (443 if https else 80)
+        return await asyncio.open_connection(
+            self.parts.hostname, port,
+            ssl=ssl.create_default_context() if https else None)
+
+    async def _exchange(self, path):
+        if self.conn is None:
+            self.conn = await self._connect()
+        reader, writer = self.conn
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' %
+                      (path, self.parts.netloc)).encode('ascii'))
+        await writer.drain()
+        version, status = (await reader.readline()).split()[:2]
+        headers = {}
+        while 1:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''): break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = (version == b'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while 1:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0: break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body, keep_alive = await reader.read(), False
+        if not keep_alive: self.close()
+        return int(status), headers, body
+
+    async def request(self, url):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+        while 1:
+            reused = self.conn is not None
+            sent = time.time()
+            try:
+                status, headers, body = await asyncio.wait_for(
+                    self._exchange(path), self.timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError):
+                self.close()
+                # As with ConnectionPool, retry once on a fresh connection.
+                if reused: continue
+                raise
+            self.clock.observe(sent, time.time(),
+                               headers.get('x-server-time'))
+            return status, body.decode('utf-8')
 
-def do_track(base_url, stream, color=False):
+    def close(self):
+        if self.conn is not None:
+            self.conn[1].close()
+            self.conn = None
+
+async def fetch_slot_async(endpoint, ts):
+    try:
+        status, body = await endpoint.request(slot_url(endpoint.base_url, ts))
+    except (OSError, ValueError, IndexError, asyncio.TimeoutError,
+            asyncio.IncompleteReadError) as exc:
+        return 'error: {}'.format(exc or type(exc).__name__)
+    if status != 200:
+        return 'error: {}'.format(body)
+    return urllib.parse.parse_qs(body)['d'][0]
+
+async def fetch_range_async(endpoint, slots):
+    query = urllib.parse.urlencode({'from': slots[0], 'to': slots[-1]})
+    try:
+        status, body = await endpoint.request(
+            endpoint.base_url.rstrip('/') + '/range?' + query)
+    except (OSError, ValueError, IndexError, asyncio.TimeoutError,
+            asyncio.IncompleteReadError):
+        status = None
+    if status == 200:
+        ret = {}
+        for line in body.splitlines():
+            params = urllib.parse.parse_qs(line)
+            ret[int(params['t'][0])] = params['d'][0]
+        return ret
+    # One connection per endpoint, so the slots are fetched in turn.
+    return {ts: await fetch_slot_async(endpoint, ts) for ts in slots}
+
+def merge_mirrors(ts, endpoints, results):
+    values = collections.Counter(r for r in results
+                                 if not r.startswith('error: '))
+    if not values:
+        return (ts, None, results[0])
+    data = values.most_common(1)[0][0]
+    note = classify(ts, data)
+    if len(values) > 1:
+        note = 'mirrors disagree: ' + ', '.join(
+            '{}={}'.format(ep.parts.netloc, r)
+            for ep, r in zip(endpoints, results) if r != data and
+            not r.startswith('error: '))
+    elif note is None and sum(values.values()) < len(results):
+        note = 'missing from ' + ', '.join(
+            ep.parts.netloc for ep, r in zip(endpoints, results)
+            if r.startswith('error: '))
+    return (ts, data, note)
+
+def track_mirrors(base_urls, start=None):
+    # Follows several servers from one event loop, merging their results
+    # per slot; slots become available two seconds before they start.
+    endpoints = [AsyncEndpoint(url) for url in base_urls]
+    loop = asyncio.new_event_loop()
+    async def calibrate():
+        async def sample(ep):
+            for i in range(CALIBRATION_SAMPLES):
+                try:
+                    await ep.request(ep.base_url)
+                except (OSError, ValueError, IndexError,
+                        asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    pass
+        await asyncio.gather(*(sample(ep) for ep in endpoints))
+    async def fetch_slot(ts):
+        # Every mirror is asked as soon as its own clock says the slot
+        # has been published.
+        async def fetch(ep):
+            await asyncio.sleep(ep.clock.fetch_delay(ts))
+            try:
+                return await asyncio.wait_for(fetch_slot_async(ep, ts),
+                                              SLOT_DEADLINE)
+            except asyncio.TimeoutError:
+                # The connection is left in the middle of an exchange.
+                ep.close()
+                return 'error: no answer within {} seconds'.format(
+                    SLOT_DEADLINE)
+        return await asyncio.gather(*(fetch(ep) for ep in endpoints))
+    async def fetch_range(slots):
+        return await asyncio.gather(*(fetch_range_async(ep, slots)
+                                      for ep in endpoints))
+    try:
+        loop.run_until_complete(calibrate())
+        clock = next((ep.clock for ep in endpoints
+                      if ep.clock.rtt is not None), ServerClock())
+        ts = None if start is None else start - start % 5
+        while 1:
+            live = int((clock.now() + PUBLISH_LEAD) / 5) * 5 - 5
+            if ts is None: ts = live
+            if ts < live:
+                slots = range(ts, min(ts + 5 * BATCH_SIZE, live), 5)
+                results = loop.run_until_complete(fetch_range(list(slots)))
+                for ts in slots:
+                    yield merge_mirrors(ts, endpoints,
+                                        [r.get(ts, 'error: missing')
+                                         for r in results])
+                ts += 5
+                continue
+            results = loop.run_until_complete(fetch_slot(ts))
+            yield merge_mirrors(ts, endpoints, results)
+            ts += 5
+    finally:
+        for ep in endpoints: ep.close()
+        loop.close()
+
+def do_track(records, stream, color=False):
     color = resolve_color(color, stream)
-    for ts, text, note in track(base_url):
+    for ts, text, note in records:
         ts_text = highlight(f'{format_timestamp(ts)} ->', '2', color)
         formatted_text = format_text(text, note, color=color)
         note_text = ' ' + highlight(f'[{note}]', '36', color) if note else ''
         line = f'{ts_text} {formatted_text}{note_text}'
         print(line, file=stream)
 
-def do_track_fancy(base_url, stream, color=False):
+def do_track_fancy(records, stream, color=False):
     color = resolve_color(color, stream)
 
     heading = ('#      '  +
@@ -99,7 +461,7 @@ def do_track_fancy(base_url, stream, color=False):
     print(highlight(heading, '2', color), file=stream)
 
     prev_date, prev_time, prev_second = None, None, None
-    for ts, text, note in track(base_url):
+    for ts, text, note in records:
         dt = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
         cur_date = dt.date()
         cur_time = (dt.hour, dt.minute)
@@ -122,6 +484,173 @@ def do_track_fancy(base_url, stream, color=False):
               file=stream, flush=True)
         prev_second = cur_second
 
+def encode_jsonl(ts, text, note):
+    return (json.dumps({'t': ts, 'd': text, 'note': note}) + '\n').encode()
+
+def encode_csv(ts, text, note):
+    buf = io.StringIO()
+    csv.writer(buf).writerow((ts, text or '', note or ''))
+    return buf.getvalue().encode('utf-8')
+
+def encode_binary(ts, text, note):
+    if text is None:
+        status = STATUS_ERROR
+    elif note is not None and note.startswith('mirrors disagree'):
+        status = STATUS_DISAGREE
+    else:
+        status = STATUS_OK
+    return BINARY_RECORD.pack(ts, status, (text or '').encode('ascii'))
+
+OUTPUT_FORMATS = {
+    'jsonl': (encode_jsonl, b''),
+    'csv': (encode_csv, b't,d,note\r\n'),
+    'binary': (encode_binary, BINARY_MAGIC)
+}
+
+class RecordSink:
+    # The path may contain strftime() fields, which are expanded with the
+    # (UTC) time of each record; a new file is started whenever the name
+    # changes. Files are appended to, and flushed at most every
+    # flush_interval seconds.
+    def __init__(self, path, fmt, flush_interval=5):
+        self.path = path
+        self.encode, self.header = OUTPUT_FORMATS[fmt]
+        self.flush_interval = flush_interval
+        self.name = None
+        self.file = None
+        self.last_flush = time.monotonic()
+
+    def _open(self, ts):
+        if self.path is None or self.path == '-':
+            if self.file is None:
+                self.file = sys.stdout.buffer
+                self.file.write(self.header)
+            return
+        name = time.strftime(self.path, time.gmtime(ts))
+        if name == self.name: return
+        self.close()
+        self.file = open(name, 'ab', buffering=1 << 16)
+        self.name = name
+        if self.file.tell() == 0: self.file.write(self.header)
+
+    def write(self, ts, text, note):
+        self._open(ts)
+        self.file.write(self.encode(ts, text, note))
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        if self.file is None: return
+        if self.name is None:
+            self.file.flush()
+        else:
+            self.file.close()
+        self.file, self.name = None, None
+
+def do_record(records, sink):
+    try:
+        for ts, text, note in records:
+            sink.write(ts, text, note)
+    finally:
+        sink.close()
+
+def decode_jsonl(stream):
+    for line in stream:
+        if not line.strip(): continue
+        obj = json.loads(line)
+        yield (obj['t'], obj.get('d'), obj.get('note'))
+
+def decode_csv(stream):
+    reader = csv.reader(io.TextIOWrapper(stream, 'utf-8', newline=''))
+    for row in reader:
+        if not row or row[0] == 't': continue
+        yield (int(row[0]), row[1] or None, row[2] or None)
+
+def decode_binary(stream):
+    size = BINARY_RECORD.size
+    while 1:
+        data = stream.read(size * 4096)
+        if len(data) % size:
+            data += stream.read(size - len(data) % size)
+        if not data: break
+        for ts, status, text in BINARY_RECORD.iter_unpack(data):
+            if status == STATUS_ERROR:
+                yield (ts, None, 'error: recorded')
+            else:
+                yield (ts, text.rstrip(b'\0').decode('ascii'),
+                       'mirrors disagree' if status == STATUS_DISAGREE
+                       else None)
+
+def read_records(stream):
+    # Accepts any of the recording formats, telling them apart by their
+    # first bytes.
+    if not hasattr(stream, 'peek'): stream = io.BufferedReader(stream)
+    head = stream.peek(8)[:8]
+    if head.startswith(BINARY_MAGIC):
+        stream.read(len(BINARY_MAGIC))
+        return decode_binary(stream)
+    elif head.startswith(b'{'):
+        return decode_jsonl(stream)
+    elif head.startswith(b't,d,note'):
+        return decode_csv(stream)
+    elif not head:
+        return iter(())
+    raise ValueError('unknown recording format')
+
+def replay(stream, speed=0):
+    # Notes are recomputed, except for those that cannot be, i.e. errors
+    # and disagreements. With a nonzero speed, slots are paced at that
+    # multiple of real time.
+    prev_ts = None
+    for ts, text, note in read_records(stream):
+        if text is not None and not (note or '').startswith(
+                'mirrors disagree'):
+            note = classify(ts, text)
+        if speed and prev_ts is not None:
+            time.sleep(max(ts - prev_ts, 0) / speed)
+        prev_ts = ts
+        yield (ts, text, note)
+
+def analyze(records):
+    notes = collections.Counter()
+    values, sync_values = [], []
+    first = last = prev = None
+    gaps = repeats = errors = 0
+    for ts, text, note in records:
+        if first is None: first = ts
+        if prev is not None:
+            if ts > prev[0] + 5: gaps += (ts - prev[0]) // 5 - 1
+            if text is not None and ts == prev[0] + 5 and text == prev[1]:
+                repeats += 1
+        last, prev = ts, (ts, text)
+        if text is None:
+            errors += 1
+            continue
+        (sync_values if ts % 60 == 0 else values).append(text)
+        if note is not None:
+            notes[note.split(':')[0]] += 1
+    # Counting over one big string is much faster than per record. Sync
+    # slots are left out of the digit statistics.
+    chars = collections.Counter(''.join(values))
+    digits = sum(chars[d] for d in '0123456789')
+    expected = digits / 10
+    chi2 = (sum((chars[d] - expected) ** 2 for d in '0123456789') /
+            expected if expected else None)
+    return {
+        'first': first, 'last': last,
+        'records': len(values) + len(sync_values) + errors,
+        'errors': errors, 'missing_slots': gaps,
+        'repeated_values': repeats,
+        'notes': dict(notes.most_common()),
+        'digit_frequency': {d: chars[d] for d in '0123456789'},
+        'digit_chi_squared': chi2,
+        'other_characters': sum(chars.values()) - digits,
+        'most_common_values':
+            collections.Counter(values).most_common(10)
+    }
+
 def do_upload(url, text):
     if not VALID_UPLOAD.match(text):
         raise ValueError('Invalid upload text')
@@ -131,32 +660,81 @@ def do_upload(url, text):
 def main():
     p = argparse.ArgumentParser(description='Receive and print 31337 '
                                             'transmissions')
-    p.add_argument('--url', '-u', default=DEFAULT_URL,
-                   help='API URL (default: %(default)s)')
+    p.add_argument('--url', '-u', action='append',
+                   help='API URL (default: %s); give several times to '
+                        'follow mirrors concurrently and compare them' %
+                        DEFAULT_URL)
     p.add_argument('--color', choices=('never', 'always', 'auto'),
                    default='auto',
                    help='Decide whether to color-code output')
     p.add_argument('--compact', '-c', action='store_true',
                    help='Display tracking output in a compact human-readable '
                         'manner')
+    p.add_argument('--format', '-f', choices=('text',) + tuple(OUTPUT_FORMATS),
+                   default='text',
+                   help='Output format; the non-text ones are meant for '
+                        'recording (default: %(default)s)')
+    p.add_argument('--output', '-o',
+                   help='Append records to this file instead of standard '
+                        'output; strftime() fields in the name (e.g. '
+                        'slots-%%Y-%%m.jsonl) start new files as time passes')
+    p.add_argument('--flush-interval', type=float, default=5,
+                   help='Seconds between flushes of recorded output '
+                        '(default: %(default)s)')
+    p.add_argument('--since', '-s', type=int,
+                   help='Start tracking at this UNIX timestamp, fetching '
+                        'missed slots in batches')
+    p.add_argument('--replay', '-r', metavar='FILE',
+                   help='Replay a recorded log (any recording format; - '
+                        'for standard input) instead of tracking live')
+    p.add_argument('--speed', type=float, default=0,
+                   help='Replay at this multiple of real time; 0 means as '
+                        'fast as possible (default: %(default)s)')
+    p.add_argument('--analyze', action='store_true',
+                   help='Print statistics about the replayed log as JSON '
+                        'instead of the records')
     p.add_argument('submit', nargs='?',
                    help='Upload text instead of retrieving updates')
     a = p.parse_args()
+    if a.output is not None and a.format == 'text':
+        p.error('--output requires a non-text --format')
+    if a.analyze and a.replay is None:
+        p.error('--analyze requires --replay')
+    urls = a.url or [DEFAULT_URL]
+    if a.replay == '-':
+        records = replay(sys.stdin.buffer, a.speed)
+    elif a.replay is not None:
+        records = replay(open(a.replay, 'rb'), a.speed)
+    elif len(urls) > 1:
+        records = track_mirrors(urls, a.since)
+    else:
+        records = track(urls[0], a.since)
 
     if a.submit is not None:
-        code, body = do_upload(a.url, a.submit.upper())
+        code, body = do_upload(urls[0], a.submit.upper())
         if code == 200:
             print('OK')
         else:
             print(f'ERROR {code}: {body}')
+    elif a.analyze:
+        json.dump(analyze(records), sys.stdout, indent=2)
+        print()
+    elif a.format != 'text':
+        # Recorders tend to be stopped with SIGTERM; flush before exiting.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            do_record(records, RecordSink(a.output, a.format,
+                                          a.flush_interval))
+        except KeyboardInterrupt:
+            pass
     elif a.compact:
         try:
-            do_track_fancy(a.url, sys.stdout, color=a.color)
+            do_track_fancy(records, sys.stdout, color=a.color)
         except KeyboardInterrupt:
             print()
     else:
         try:
-            do_track(a.url, sys.stdout, color=a.color)
+            do_track(records, sys.stdout, color=a.color)
         except KeyboardInterrupt:
             pass
 
@@ -1,8 +1,21 @@
 
 # -*- coding: ascii -*-
 
-import os, io
+import os, io, sys
+import asyncio
+import atexit
+import bisect
 import calendar
+import functools
+import threading
+import traceback
+import concurrent.futures
+import time
+import gzip
+import hashlib
+import pickle
+import shutil
+import tempfile
 import urllib.parse
 import email.utils
 import posixpath
@@ -22,15 +35,73 @@ MIME_TYPES = {
     '.html': 'text/html; charset=utf-8',
     '.css': 'text/css',
     '.js': 'application/javascript',
-    '.ico': 'image/vnd.microsoft.icon'
+    '.json': 'application/json',
+    '.ico': 'image/vnd.microsoft.icon',
+    '.mp3': 'audio/mpeg',
+    '.woff': 'font/woff'
 }
 
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'image/svg+xml')
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec')
+
+@functools.lru_cache(maxsize=256)
 def parse_http_date(string):
     fields = email.utils.parsedate(string)
     return calendar.timegm(fields)
 
+@functools.lru_cache(maxsize=256)
+def _format_http_date(seconds):
+    tm = time.gmtime(seconds)
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _WEEKDAYS[tm.tm_wday], tm.tm_mday, _MONTHS[tm.tm_mon - 1], tm.tm_year,
+        tm.tm_hour, tm.tm_min, tm.tm_sec)
+
 def format_http_date(timestamp):
-    return email.utils.formatdate(timestamp, usegmt=True)
+    if timestamp is None: timestamp = time.time()
+    return _format_http_date(int(timestamp // 1))
+
+def _parse_query(string):
+    if '%' in string or '+' in string:
+        pairs = urllib.parse.parse_qs(string)
+        return {k: v[-1] for k, v in pairs.items()}
+    ret = {}
+    for item in string.split('&'):
+        name, sep, value = item.partition('=')
+        if value: ret[name] = value
+    return ret
+
+_parse_query_cached = functools.lru_cache(maxsize=1024)(_parse_query)
+
+def parse_query(string):
+    # Returns a dict of the last value given for each name, like parse_qs()
+    # with blank values dropped. Short query strings are memoized since
+    # clients keep requesting the same handful of them; callers get a copy
+    # of the memoized result, which they are free to modify.
+    if len(string) > 256:
+        return _parse_query(string)
+    return dict(_parse_query_cached(string))
+
+def make_etag(data):
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+_file_etags = {}
+
+def file_etag(path, fp, status):
+    key = (status.st_mtime_ns, status.st_size)
+    cached = _file_etags.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha1()
+    for block in iter(lambda: fp.read(65536), b''):
+        digest.update(block)
+    fp.seek(0)
+    etag = '"%s"' % digest.hexdigest()
+    _file_etags[path] = (key, etag)
+    return etag
 
 def parse_cookies(string):
     ret = {}
@@ -53,6 +124,46 @@ def format_cookie(name, value, attrs):
         if v is not None: ret.extend(('=', v))
     return ''.join(ret)
 
+def accepts_encoding(header, encoding):
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() not in (encoding, '*'): continue
+        for param in params.split(';'):
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    return float(v) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def parse_range(value, size):
+    # Returns None if the header should be ignored, False if the range is
+    # unsatisfiable, and an inclusive (start, end) tuple otherwise.
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or size == 0: return False
+            return (max(size - suffix, 0), size - 1)
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if end is not None and end < start:
+        return None
+    elif start >= size:
+        return False
+    elif end is None or end >= size:
+        end = size - 1
+    return (start, end)
+
 def make_relative(path):
     ret = posixpath.relpath(posixpath.join('/', path), '/')
     if ret == '.': ret = ''
@@ -62,6 +173,8 @@ def join_paths(base, subpath):
     return posixpath.join(base, make_relative(subpath))
 
 class InputWrapper(io.RawIOBase):
+    __slots__ = ('wrapped', 'remaining')
+
     def __init__(self, wrapped, remaining=None):
         self.wrapped = wrapped
         self.remaining = remaining
@@ -86,13 +199,406 @@ class InputWrapper(io.RawIOBase):
         buf[:len(rd)] = rd
         return len(rd)
 
+class FileWrapper:
+    def __init__(self, filelike, blksize=8192, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize
+            if remaining is not None: size = min(size, remaining)
+            data = self.filelike.read(size)
+            if not data: break
+            if remaining is not None: remaining -= len(data)
+            yield data
+
+class StaticEntry:
+    def __init__(self, path, body, mtime, mime=None, compress=False,
+                 headers=()):
+        self.path = path
+        self.body = body
+        self.size = len(body)
+        self.mtime = int(mtime)
+        self.mtime_ns = None
+        self.checked = time.monotonic()
+        self.etag = make_etag(body)
+        self.gzip_etag = self.etag[:-1] + '-gz"'
+        self.headers = [('Accept-Ranges', 'bytes')]
+        self.headers.extend(headers)
+        if mime is not None:
+            self.headers.append(('Content-Type', mime))
+        self.headers.append(('Last-Modified', format_http_date(self.mtime)))
+        self.gzip_body = None
+        if compress:
+            gzip_body = gzip.compress(body, mtime=0)
+            if len(gzip_body) < len(body):
+                self.gzip_body = gzip_body
+                self.headers.append(('Vary', 'Accept-Encoding'))
+        self.gzip_headers = self.headers + [
+            ('Content-Encoding', 'gzip'),
+            ('ETag', self.gzip_etag),
+            ('Content-Length', str(len(self.gzip_body or b'')))]
+        self.headers += [('ETag', self.etag),
+                         ('Content-Length', str(len(body)))]
+
+class StaticCache:
+    def __init__(self, check_interval=1, max_file_size=1 << 20):
+        self.check_interval = check_interval
+        self.max_file_size = max_file_size
+        self.entries = {}
+
+    def load(self, path, mime_types):
+        with open(path, 'rb') as fp:
+            status = os.fstat(fp.fileno())
+            if status.st_size > self.max_file_size: return None
+            body = fp.read()
+        mime = mime_types.get(posixpath.splitext(path)[1])
+        compress = mime is not None and mime.startswith(COMPRESSIBLE_TYPES)
+        entry = StaticEntry(path, body, status.st_mtime, mime, compress)
+        entry.mtime_ns = status.st_mtime_ns
+        self.entries[path] = entry
+        return entry
+
+    def get(self, path, mime_types=None):
+        if mime_types is None: mime_types = MIME_TYPES
+        entry = self.entries.get(path)
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry.checked < self.check_interval:
+                return entry
+            try:
+                status = os.stat(path)
+            except OSError:
+                self.entries.pop(path, None)
+                return None
+            if (status.st_mtime_ns == entry.mtime_ns and
+                    status.st_size == entry.size):
+                entry.checked = now
+                return entry
+        try:
+            return self.load(path, mime_types)
+        except IOError:
+            self.entries.pop(path, None)
+            return None
+
+def _format_labels(names, values, extra=''):
+    items = []
+    for n, v in zip(names, values):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        items.append('%s="%s"' % (n, v.replace('\n', '\\n')))
+    if extra: items.append(extra)
+    return '{%s}' % ','.join(items) if items else ''
+
+class MetricValue:
+    # Every thread only ever writes its own cell, so updates need no lock.
+    # Thread idents may be reused, but never by two live threads at once.
+    __slots__ = ('cells', 'width')
+
+    def __init__(self, width=1):
+        self.cells = {}
+        self.width = width
+
+    def cell(self):
+        ident = threading.get_ident()
+        cell = self.cells.get(ident)
+        if cell is None:
+            cell = self.cells.setdefault(ident, [0] * self.width)
+        return cell
+
+    def totals(self):
+        ret = [0] * self.width
+        for cell in list(self.cells.values()):
+            for i, v in enumerate(cell): ret[i] += v
+        return ret
+
+    def export(self):
+        return self.totals()
+
+class CounterValue(MetricValue):
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def get(self):
+        return self.totals()[0]
+
+class GaugeValue(MetricValue):
+    __slots__ = ('base',)
+
+    def __init__(self):
+        MetricValue.__init__(self)
+        self.base = 0
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def dec(self, amount=1):
+        self.cell()[0] -= amount
+
+    def set(self, value):
+        self.base = value - self.totals()[0]
+
+    def get(self):
+        return self.base + self.totals()[0]
+
+    def export(self):
+        return [self.get()]
+
+class HistogramValue(MetricValue):
+    # Cells hold a count per bucket (the last one being +Inf) and the sum.
+    __slots__ = ('bounds',)
+
+    def __init__(self, bounds):
+        MetricValue.__init__(self, len(bounds) + 2)
+        self.bounds = bounds
+
+    def observe(self, value):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Expected labels %r for metric %s' %
+                                 (self.labelnames, self.name))
+            child = self.children.setdefault(values, self.make_value())
+        return child
+
+    def make_value(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        return {values: child.export()
+                for values, child in list(self.children.items())}
+
+    def samples(self, snapshot):
+        for values, totals in sorted(snapshot.items()):
+            yield '%s%s %s' % (self.name,
+                               _format_labels(self.labelnames, values),
+                               totals[0])
+
+    def render(self, snapshot=None):
+        if snapshot is None: snapshot = self.snapshot()
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self.samples(snapshot))
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def make_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def make_value(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self, snapshot):
+        if self.function is None:
+            return Metric.samples(self, snapshot)
+        return ['%s %s' % (self.name, self.function())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        Metric.__init__(self, name, help, labels)
+        if buckets is None: buckets = self.DEFAULT_BUCKETS
+        self.buckets = tuple(sorted(buckets))
+
+    def make_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self, snapshot):
+        for values, totals in sorted(snapshot.items()):
+            count = 0
+            for bound, n in zip(self.buckets + ('+Inf',), totals):
+                count += n
+                yield '%s_bucket%s %s' % (self.name, _format_labels(
+                    self.labelnames, values, 'le="%s"' % bound), count)
+            labels = _format_labels(self.labelnames, values)
+            yield '%s_sum%s %s' % (self.name, labels, totals[-1])
+            yield '%s_count%s %s' % (self.name, labels, count)
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Metrics:
+    publish_interval = 1
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.publisher_pid = None
+        self.in_flight = self.gauge('http_requests_in_flight',
+                                    'Requests currently being served')
+        self.responses = self.counter('http_responses_total',
+                                      'Responses by route and status code',
+                                      ('route', 'code'))
+        self.duration = self.histogram('http_request_duration_seconds',
+                                       'Time until the response was closed',
+                                       ('route',))
+        self.bytes_sent = self.counter('http_response_bytes_total',
+                                       'Response body bytes by route',
+                                       ('route',))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def share(self, directory=None):
+        # Call this before forking workers. Every worker then publishes its
+        # values to a file of its own in the directory, and render() adds
+        # up those of all workers, so that any of them can be scraped.
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='wsgif-metrics-')
+            atexit.register(shutil.rmtree, directory, True)
+        self.directory = directory
+
+    def snapshot(self):
+        return {m.name: m.snapshot() for m in self.metrics}
+
+    def publish(self):
+        path = os.path.join(self.directory, '%d.pickle' % os.getpid())
+        with open(path + '.tmp', 'wb') as fp:
+            pickle.dump(self.snapshot(), fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def _start_publisher(self):
+        # Threads do not survive fork(), so every worker starts its own.
+        self.publisher_pid = os.getpid()
+        threading.Thread(target=self._run_publisher, daemon=True).start()
+
+    def _run_publisher(self):
+        while 1:
+            time.sleep(self.publish_interval)
+            try:
+                self.publish()
+            except Exception:
+                traceback.print_exc()
+
+    def collect(self):
+        # Counters and histograms of workers that have exited are kept, so
+        # that totals never go backwards; their gauges are dropped.
+        snapshots = [(True, self.snapshot())]
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.pickle'): continue
+            pid = int(filename[:-7])
+            if pid == os.getpid(): continue
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as fp:
+                    snapshots.append((_process_exists(pid), pickle.load(fp)))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+        merged = {}
+        for alive, data in snapshots:
+            for metric in self.metrics:
+                if metric.kind == 'gauge' and not alive: continue
+                target = merged.setdefault(metric.name, {})
+                for values, totals in data.get(metric.name, {}).items():
+                    current = target.get(values)
+                    if current is not None:
+                        totals = [a + b for a, b in zip(current, totals)]
+                    target[values] = totals
+        return merged
+
+    def render(self):
+        if self.directory is None:
+            return ''.join(m.render() for m in self.metrics)
+        merged = self.collect()
+        return ''.join(m.render(merged.get(m.name, {})) for m in self.metrics)
+
+    def record(self, route, status, elapsed, sent):
+        if self.directory is not None and self.publisher_pid != os.getpid():
+            self._start_publisher()
+        self.responses.labels(route, status[:3] if status else '500').inc()
+        self.duration.labels(route).observe(elapsed)
+        self.bytes_sent.labels(route).inc(sent)
+
+def file_response(result):
+    if isinstance(result, ApplicationWrapper): result = result.result
+    return result if isinstance(result, FileWrapper) else None
+
+def async_response(result):
+    # Responses offering __aiter__ are streamed by the asyncio server
+    # without holding a pool thread; they must have called start_response()
+    # by the time they are returned.
+    if isinstance(result, ApplicationWrapper): return result.async_result()
+    return result if hasattr(result, '__aiter__') else None
+
 class ApplicationWrapper:
+    __slots__ = ('parent', 'environ', 'start_response', 'script_name',
+                 'route', 'path', 'query', 'app', 'result', 'status',
+                 'started', 'sent', '_server_start_response')
+
     factory = None
     static_root = None
+    static_cache = None
+    metrics = None
 
     @classmethod
     def create(cls, factory, **kwds):
         kwds['factory'] = staticmethod(factory)
+        kwds.setdefault('__slots__', ())
         return type('<anonymous:%s>' % cls.__name__, (cls,), kwds)
 
     def __init__(self, environ, start_response):
@@ -103,13 +609,87 @@ class ApplicationWrapper:
         self.route = ''
         self.path = environ.get('PATH_INFO', '')
         self.query = environ.get('QUERY_STRING', '')
-        self.app = self.factory(self)
-        self.response = iter(self.app)
+        self.result = None
+        self.sent = None
+        if self.metrics is not None:
+            self.status = None
+            self.started = time.perf_counter()
+            self._server_start_response = start_response
+            self.start_response = self._record_status
+            self.metrics.in_flight.inc()
+        try:
+            self.app = self.factory(self)
+            # Applications may hand off to further applications; unwrap
+            # those so that servers see the actual response object.
+            result = self.app
+            while isinstance(result, Application):
+                result = result.process()
+            self.result = result
+        except BaseException:
+            if self.metrics is not None: self._finish()
+            raise
+
+    def _record_status(self, status, headers, exc_info=None):
+        self.status = status
+        if exc_info is None:
+            return self._server_start_response(status, headers)
+        else:
+            return self._server_start_response(status, headers, exc_info)
 
     def __iter__(self):
-        return self.response
+        if self.metrics is None:
+            return iter(self.result)
+        return self._count_bytes()
+
+    def _count_bytes(self):
+        self.sent = 0
+        for chunk in self.result:
+            self.sent += len(chunk)
+            yield chunk
+
+    def async_result(self):
+        if not hasattr(self.result, '__aiter__'): return None
+        if self.metrics is None: return self.result
+        return self._count_bytes_async()
+
+    async def _count_bytes_async(self):
+        self.sent = 0
+        async for chunk in self.result:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if self.metrics is not None and self.started is not None:
+                self._finish()
+        finally:
+            if hasattr(self.result, 'close'): self.result.close()
+
+    def _finish(self):
+        elapsed = time.perf_counter() - self.started
+        self.started = None
+        sent = self.sent
+        if sent is None:
+            # Files sent with sendfile() bypass iteration.
+            wrapper = file_response(self.result)
+            sent = 0
+            if wrapper is not None and self.environ['REQUEST_METHOD'] != 'HEAD':
+                try:
+                    sent = (wrapper.length if wrapper.length is not None else
+                            os.fstat(wrapper.filelike.fileno()).st_size -
+                            (wrapper.offset or 0))
+                except (AttributeError, OSError, io.UnsupportedOperation):
+                    pass
+        self.metrics.in_flight.dec()
+        self.metrics.record(self.environ.get('wsgif.route', ''), self.status,
+                            elapsed, sent)
 
 class Application:
+    __slots__ = ('parent', 'environ', '_start_response', 'method',
+                 'script_name', 'route', 'path', 'query', '_req_cookies',
+                 'response_cookies', 'response_headers', '_query_vars',
+                 '_req_body')
+
     def __init__(self, parent):
         self.parent = parent
         self.environ = parent.environ
@@ -153,8 +733,7 @@ class Application:
     @property
     def query_vars(self):
         if self._query_vars is None:
-            pairs = urllib.parse.parse_qs(self.query)
-            self._query_vars = {k: v[-1] for k, v in pairs.items()}
+            self._query_vars = parse_query(self.query)
         return self._query_vars
 
     @property
@@ -184,6 +763,11 @@ class Application:
         ])
         return [text]
 
+    def send_response(self, status, headers, body):
+        # The header list is copied since start_response() extends it.
+        self.start_response(status, list(headers))
+        return [body]
+
     def send_redirect(self, code, url):
         self.start_response('%s %s' % (code, http_phrase(code)), [
             ('Location', url),
@@ -195,6 +779,92 @@ class Application:
     def static_root(self):
         return self.parent.static_root
 
+    @property
+    def static_cache(self):
+        return self.parent.static_cache
+
+    def not_modified_since(self, last_modified):
+        value = self.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if not value:
+            return False
+        try:
+            return last_modified <= parse_http_date(value)
+        except (TypeError, ValueError):
+            return False
+
+    def etag_matches(self, etag):
+        value = self.environ.get('HTTP_IF_NONE_MATCH')
+        if not value:
+            return False
+        elif value.strip() == '*':
+            return True
+        # Weak comparison, as appropriate for If-None-Match.
+        if etag.startswith('W/'): etag = etag[2:]
+        for item in value.split(','):
+            item = item.strip()
+            if item.startswith('W/'): item = item[2:]
+            if item == etag: return True
+        return False
+
+    def is_not_modified(self, etag=None, last_modified=None):
+        # If-None-Match takes precedence over If-Modified-Since.
+        if etag is not None and 'HTTP_IF_NONE_MATCH' in self.environ:
+            return self.etag_matches(etag)
+        elif last_modified is not None:
+            return self.not_modified_since(last_modified)
+        return False
+
+    def select_range(self, size, etag=None, last_modified=None):
+        value = self.environ.get('HTTP_RANGE')
+        if not value or self.method not in ('GET', 'HEAD'):
+            return None
+        if_range = self.environ.get('HTTP_IF_RANGE')
+        if if_range and if_range.startswith(('"', 'W/')):
+            # Only strong validators may be used here.
+            if etag is None or etag.startswith('W/') or if_range != etag:
+                return None
+        elif if_range:
+            try:
+                if parse_http_date(if_range) != last_modified:
+                    return None
+            except (TypeError, ValueError):
+                return None
+        return parse_range(value, size)
+
+    def send_range_error(self, size):
+        self.start_response('416 Range Not Satisfiable', [
+            ('Content-Range', 'bytes */%s' % size),
+            ('Content-Length', '0')
+        ])
+        return []
+
+    def start_partial(self, headers, byte_range, size):
+        start, end = byte_range
+        headers = [h for h in headers if h[0] != 'Content-Length']
+        headers.append(('Content-Range', 'bytes %s-%s/%s' % (start, end, size)))
+        headers.append(('Content-Length', str(end - start + 1)))
+        self.start_response('206 Partial Content', headers)
+
+    def send_entry(self, entry):
+        byte_range = self.select_range(entry.size, entry.etag, entry.mtime)
+        # Ranges always refer to the identity encoding.
+        if (entry.gzip_body is not None and byte_range is None and
+                accepts_encoding(self.environ.get('HTTP_ACCEPT_ENCODING', ''),
+                                 'gzip')):
+            headers, body = entry.gzip_headers, entry.gzip_body
+            etag = entry.gzip_etag
+        else:
+            headers, body, etag = entry.headers, entry.body, entry.etag
+        if self.is_not_modified(etag, entry.mtime):
+            self.start_response('304 Not Modified', list(headers))
+            return []
+        elif byte_range is False:
+            return self.send_range_error(entry.size)
+        elif byte_range is not None:
+            self.start_partial(headers, byte_range, entry.size)
+            return [body[byte_range[0]:byte_range[1] + 1]]
+        return self.send_response('200 OK', headers, body)
+
     def open_static(self, path, mime_types=None):
         if mime_types is None: mime_types = MIME_TYPES
         info, headers = {}, []
@@ -204,42 +874,53 @@ class Application:
             headers.append(('Content-Type', info['mime']))
         except KeyError:
             pass
+        fullpath = join_paths(self.static_root, path)
         try:
-            fp = open(join_paths(self.static_root, path), 'rb')
+            fp = open(fullpath, 'rb')
         except IOError:
             return (None, None, None)
         try:
             status = os.fstat(fp.fileno())
+            headers.append(('Accept-Ranges', 'bytes'))
             info['length'] = status.st_size
             info['mtime'] = int(status.st_mtime)
             headers.append(('Content-Length', str(info['length'])))
             headers.append(('Last-Modified', format_http_date(info['mtime'])))
+            info['etag'] = file_etag(fullpath, fp, status)
+            headers.append(('ETag', info['etag']))
         except Exception:
             pass
         return (fp, info, headers)
 
     def send_static(self, filelike, blksize=None, mime_types=None):
-        headers, last_modified = [], None
+        headers, last_modified, etag = [], None, None
+        if isinstance(filelike, str) and self.static_cache is not None:
+            entry = self.static_cache.get(
+                join_paths(self.static_root, filelike), mime_types)
+            if entry is not None:
+                return self.send_entry(entry)
         if isinstance(filelike, str):
             # File is closed by the server.
             filelike, info, headers = self.open_static(filelike, mime_types)
             if filelike is None:
                 return self.send_code(404)
-            last_modified = info.get('mtime')
+            last_modified, etag = info.get('mtime'), info.get('etag')
+        if self.is_not_modified(etag, last_modified):
+            filelike.close()
+            self.start_response('304 Not Modified', headers)
+            return []
+        byte_range = None
         if last_modified is not None:
-            value = self.environ.get('HTTP_IF_MODIFIED_SINCE')
-            if value:
-                try:
-                    pvalue = parse_http_date(value)
-                except ValueError:
-                    pass
-                else:
-                    if last_modified <= pvalue:
-                        self.start_response('304 Not Modified', headers)
-                        return []
+            byte_range = self.select_range(info['length'], etag, last_modified)
+        if byte_range is False:
+            filelike.close()
+            return self.send_range_error(info['length'])
+        elif byte_range is not None:
+            self.start_partial(headers, byte_range, info['length'])
+            return FileWrapper(filelike, blksize or 8192, byte_range[0],
+                               byte_range[1] - byte_range[0] + 1)
         self.start_response('200 OK', headers)
-        wrapper = self.environ.get('wsgi.file_wrapper',
-                                   wsgiref.util.FileWrapper)
+        wrapper = self.environ.get('wsgi.file_wrapper', FileWrapper)
         if blksize is None:
             return wrapper(filelike)
         else:
@@ -265,6 +946,8 @@ class Application:
                             urllib.parse.urljoin)
 
 class FixedApplication(Application):
+    __slots__ = ()
+
     code = None
     location = None
     text = None
@@ -273,6 +956,7 @@ class FixedApplication(Application):
     @classmethod
     def create(cls, code, **kwds):
         kwds['code'] = code
+        kwds.setdefault('__slots__', ())
         return type('<anonymous:%s>' % cls.__name__, (cls,), kwds)
 
     def process(self):
@@ -283,6 +967,8 @@ class FixedApplication(Application):
                                   self.content_type)
 
 class StaticApplication(Application):
+    __slots__ = ()
+
     subroot = None
     strip_prefix = None
     blksize = None
@@ -292,6 +978,7 @@ class StaticApplication(Application):
     def create(cls, subroot=None, **kwds):
         if subroot is None: subroot = ''
         kwds.update(subroot=subroot)
+        kwds.setdefault('__slots__', ())
         return type('<anonymous:%s>' % cls.__name__, (cls,), kwds)
 
     @property
@@ -303,45 +990,82 @@ class StaticApplication(Application):
         return self.send_static(path, self.blksize, self.mime_types)
 
 class WSGIApplication(Application):
+    __slots__ = ()
+
     wrapped = None
 
     @classmethod
     def wrap(cls, wrapped, **kwds):
         kwds['wrapped'] = staticmethod(wrapped)
+        kwds.setdefault('__slots__', ())
         return type('<anonymous:%s>' % cls.__name__, (cls,), kwds)
 
     def process(self):
         self.environ['SCRIPT_NAME'] = self.script_name + self.route
         return self.wrapped(self.environ, self.start_response)
 
+def compile_routes(routes):
+    # One (exact, prefixes, prefix_lengths) table per method, with routes
+    # accepting any method merged in; the None table serves other methods.
+    # Prefix keys end in a slash. The lowest position wins, as with a
+    # linear scan.
+    methods = set(ent[2] for ent in routes)
+    methods.add(None)
+    tables = {}
+    for m in methods:
+        exact, prefixes = {}, {}
+        for position, (routepath, extend, method, callback) in \
+                enumerate(routes):
+            if method is not None and method != m:
+                continue
+            pattern = routepath + '*' if extend else routepath
+            entry = (position, routepath, callback, pattern)
+            if not extend:
+                exact.setdefault(routepath, entry)
+            elif routepath.endswith('/'):
+                prefixes.setdefault(routepath, entry)
+            else:
+                exact.setdefault(routepath, entry)
+                prefixes.setdefault(routepath + '/', entry)
+        tables[m] = (exact, prefixes, sorted(set(map(len, prefixes))))
+    return tables
+
+def match_route(tables, method, path):
+    exact, prefixes, lengths = tables.get(method) or tables[None]
+    best = exact.get(path)
+    for n in lengths:
+        if n > len(path): break
+        entry = prefixes.get(path[:n])
+        if entry is not None and (best is None or entry[0] < best[0]):
+            best = entry
+    return best
+
 class Router(Application):
+    __slots__ = ()
+
     routes = None
     fallback = None
+    table = None
 
     @classmethod
     def create(cls, routes, fallback, **kwds):
-        kwds.update(routes=routes, fallback=fallback)
+        routes = list(routes)
+        kwds.update(routes=routes, fallback=fallback,
+                    table=compile_routes(routes))
+        kwds.setdefault('__slots__', ())
         return type('<anonymous:%s>' % cls.__name__, (cls,), kwds)
 
     def process(self):
-        path = self.path
-        for routepath, extend, method, callback in self.routes:
-            if method is not None and self.method != method:
-                continue
-            elif not extend:
-                if path != routepath: continue
-            elif not path.startswith(routepath):
-                continue
-            elif not routepath.endswith('/'):
-                lrp = len(routepath)
-                if len(path) > lrp and path[lrp] != '/': continue
-            return self._process_route(routepath, callback)
-        return self._process_fallback()
+        match = match_route(self.table, self.method, self.path)
+        if match is None:
+            return self._process_fallback()
+        self.environ['wsgif.route'] = self.route + match[3]
+        return self._process_route(match[1], match[2])
 
     def _process_route(self, routepath, callback):
         if not self.path.startswith(routepath):
             raise RuntimeError('Invalid route key %r for PATH_INFO %r' %
-                               (key, self.path))
+                               (routepath, self.path))
         truncpath = routepath[:-1] if routepath.endswith('/') else routepath
         self.route += truncpath
         self.path = self.path[len(truncpath):]
@@ -393,9 +1117,354 @@ class RouteBuilder:
         else:
             return callback
 
-def run_app(app):
-    import sys
+class AsyncServer:
+    max_header_size = 65536
+    max_body_size = 16777216
+    keepalive_timeout = 30
+
+    def __init__(self, app, host='', port=8080, threads=64):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.server_name = host or 'localhost'
+
+    async def serve(self, sock=None):
+        if sock is None:
+            server = await asyncio.start_server(self.handle_connection,
+                                                self.host or None, self.port,
+                                                limit=self.max_header_size,
+                                                backlog=1024)
+        else:
+            server = await asyncio.start_server(self.handle_connection,
+                                                sock=sock,
+                                                limit=self.max_header_size)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self, sock=None):
+        try:
+            asyncio.run(self.serve(sock))
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def read_body(self, reader, writer, headers):
+        if headers.get('HTTP_EXPECT', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in headers.get('HTTP_TRANSFER_ENCODING', '').lower():
+            chunks, total = [], 0
+            while 1:
+                line = await reader.readuntil(b'\r\n')
+                size = int(line.split(b';', 1)[0], 16)
+                total += size
+                if total > self.max_body_size: return None
+                if size == 0: break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # Discard trailers.
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+            headers['CONTENT_LENGTH'] = str(total)
+            return b''.join(chunks)
+        length = int(headers.get('CONTENT_LENGTH') or 0)
+        if length > self.max_body_size: return None
+        return await reader.readexactly(length)
+
+    def make_environ(self, writer, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': (writer.get_extra_info('peername') or ('',))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper
+        }
+        environ.update(headers)
+        return environ
+
+    async def handle_request(self, reader, writer):
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                      self.keepalive_timeout)
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self.send_error(writer, 400)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if not line: continue
+            name, _, value = line.partition(':')
+            key = name.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in headers:
+                headers[key] += ',' + value.strip()
+            else:
+                headers[key] = value.strip()
+        connection = headers.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        try:
+            body = await self.read_body(reader, writer, headers)
+        except ValueError:
+            # Malformed Content-Length or chunk size.
+            await self.send_error(writer, 400)
+            return False
+        if body is None:
+            await self.send_error(writer, 413)
+            return False
+        environ = self.make_environ(writer, method, target, version, headers,
+                                    body)
+        return await self.respond(writer, environ, keep_alive,
+                                  method == 'HEAD')
+
+    async def send_error(self, writer, code):
+        text = ('%s %s' % (code, http_phrase(code))).encode('ascii')
+        writer.write(b'HTTP/1.1 %s\r\nContent-Type: text/plain; '
+                     b'charset=utf-8\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n%s' % (text, len(text), text))
+        await writer.drain()
+
+    def call_app(self, environ):
+        state = {}
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None:
+                try:
+                    if 'sent' in state:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif 'status' in state:
+                raise RuntimeError('start_response() called twice')
+            state['status'], state['headers'] = status, headers
+            return state.setdefault('written', []).append
+        result = self.app(environ, start_response)
+        if file_response(result) is not None:
+            return state, [], result, None
+        stream = async_response(result)
+        if stream is not None:
+            return state, [], result, stream.__aiter__()
+        elif isinstance(result, (list, tuple)):
+            chunks = list(result)
+            if hasattr(result, 'close'): result.close()
+            return state, chunks, None, None
+        iterator = iter(result)
+        # Fetch the first chunk eagerly so that start_response() has been
+        # called by the time this returns.
+        for chunk in iterator:
+            return state, [chunk], result, iterator
+        if hasattr(result, 'close'): result.close()
+        return state, [], None, None
+
+    def format_head(self, state, keep_alive, chunked):
+        names = set()
+        lines = ['HTTP/1.1 ' + state['status']]
+        for name, value in state['headers']:
+            names.add(name.lower())
+            lines.append('%s: %s' % (name, value))
+        if 'date' not in names:
+            lines.append('Date: ' + format_http_date(None))
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        if not keep_alive:
+            lines.append('Connection: close')
+        lines.extend(('', ''))
+        return '\r\n'.join(lines).encode('latin-1')
+
+    async def respond(self, writer, environ, keep_alive, head_only):
+        loop = asyncio.get_running_loop()
+        try:
+            state, chunks, result, iterator = await loop.run_in_executor(
+                self.executor, self.call_app, environ)
+            if 'status' not in state:
+                raise RuntimeError('start_response() not called')
+        except Exception:
+            traceback.print_exc()
+            await self.send_error(writer, 500)
+            return False
+        chunks = state.pop('written', []) + chunks
+        has_length = any(n.lower() == 'content-length'
+                         for n, v in state['headers'])
+        chunked = (not has_length and not head_only and
+                   environ['SERVER_PROTOCOL'] == 'HTTP/1.1')
+        if not has_length and not chunked: keep_alive = False
+        state['sent'] = True
+        writer.write(self.format_head(state, keep_alive, chunked))
+        wrapper = file_response(result)
+        is_async = hasattr(iterator, '__anext__')
+        try:
+            if wrapper is not None and not chunked:
+                # Let the kernel copy file contents straight to the socket
+                # where possible.
+                if not head_only:
+                    await writer.drain()
+                    await loop.sendfile(writer.transport, wrapper.filelike,
+                                        wrapper.offset or 0, wrapper.length)
+                return keep_alive
+            elif wrapper is not None:
+                iterator = iter(result)
+            while 1:
+                if not head_only:
+                    for chunk in chunks:
+                        if not chunk: continue
+                        if chunked:
+                            writer.write(b'%x\r\n' % len(chunk))
+                            writer.write(chunk)
+                            writer.write(b'\r\n')
+                        else:
+                            writer.write(chunk)
+                await writer.drain()
+                if iterator is None: break
+                if is_async:
+                    try:
+                        chunk = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    chunk = await loop.run_in_executor(self.executor, next,
+                                                       iterator, None)
+                    if chunk is None: break
+                chunks = [chunk]
+        finally:
+            if is_async and hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+            if result is not None and hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return keep_alive
+
+def make_server(app, host='', port=8080, server='wsgiref', threads=64,
+                sock=None):
+    import socket
+    import socketserver
     import wsgiref.simple_server
+    class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                              wsgiref.simple_server.WSGIServer):
+        daemon_threads = True
+        request_queue_size = 1024
+    class SendfileHandler(wsgiref.simple_server.ServerHandler):
+        wsgi_file_wrapper = FileWrapper
+        sock = None
+        def result_is_file(self):
+            return file_response(self.result) is not None
+        def sendfile(self):
+            wrapper = file_response(self.result)
+            try:
+                wrapper.filelike.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                return False
+            if not self.headers_sent:
+                self.bytes_sent = wrapper.length or 0
+                self.send_headers()
+            self._flush()
+            self.sock.sendfile(wrapper.filelike, wrapper.offset or 0,
+                               wrapper.length)
+            return True
+    class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+        # Mirrors the base class, substituting the handler above.
+        def handle(self):
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+            if not self.parse_request():
+                return
+            handler = SendfileHandler(self.rfile, self.wfile,
+                                      self.get_stderr(), self.get_environ(),
+                                      multithread=True)
+            handler.request_handler = self
+            handler.sock = self.connection
+            handler.run(self.server.get_app())
+    if server == 'asyncio':
+        httpd = AsyncServer(app, host, port, threads)
+        if sock is not None:
+            return lambda: httpd.serve_forever(sock)
+        return httpd.serve_forever
+    if sock is None:
+        httpd = wsgiref.simple_server.make_server(
+            host, port, app, server_class=ThreadingWSGIServer,
+            handler_class=RequestHandler)
+        return httpd.serve_forever
+    # Adopt an already-listening socket (inherited from the parent of a
+    # pre-forked worker) instead of binding a new one.
+    httpd = ThreadingWSGIServer((host, port), RequestHandler,
+                                bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    httpd.server_address = sock.getsockname()
+    httpd.server_name = socket.getfqdn(httpd.server_address[0])
+    httpd.server_port = httpd.server_address[1]
+    httpd.setup_environ()
+    httpd.set_app(app)
+    return httpd.serve_forever
+
+def run_workers(serve, count):
+    import signal
+    children = set()
+    def terminate(signum, frame):
+        sys.exit(0)
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                serve()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.add(pid)
+    # Make sure that the workers go away along with the parent.
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for i in range(count): spawn()
+        # Replace workers that die unexpectedly.
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            sys.stderr.write('Worker %s exited with status %s\n' %
+                             (pid, status))
+            spawn()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+def run_app(app, before_fork=None):
+    import socket
     import argparse
     # Parse arguments
     p = argparse.ArgumentParser()
@@ -404,14 +1473,34 @@ def run_app(app):
                        'interfaces)')
     p.add_argument('--port', default=8080, type=int,
                    help='The port to bind to (default 8080)')
+    p.add_argument('--server', choices=('wsgiref', 'asyncio'),
+                   default='wsgiref',
+                   help='The server implementation to use (default wsgiref)')
+    p.add_argument('--threads', default=64, type=int,
+                   help='The amount of worker threads for the asyncio server '
+                       '(default 64)')
+    p.add_argument('--workers', default=1, type=int,
+                   help='The amount of pre-forked worker processes sharing '
+                       'the listening socket (default 1)')
     res = p.parse_args()
     # Create server
-    httpd = wsgiref.simple_server.make_server(res.host, res.port, app)
+    if res.workers > 1:
+        sock = socket.create_server((res.host, res.port), backlog=1024)
+        metrics = getattr(app, 'metrics', None)
+        if metrics is not None: metrics.share()
+        if before_fork is not None: before_fork()
+        serve = make_server(app, res.host, res.port, res.server, res.threads,
+                            sock)
+    else:
+        serve = make_server(app, res.host, res.port, res.server, res.threads)
     # Print status message
     display_host = res.host if res.host else '*'
     sys.stderr.write('Serving HTTP on %s:%s...\n' % (display_host, res.port))
     # Main loop
     try:
-        httpd.serve_forever()
+        if res.workers > 1:
+            run_workers(serve, res.workers)
+        else:
+            serve()
     except KeyboardInterrupt:
         sys.stderr.write('\n')